@@ -142,7 +142,8 @@ class IsGrantedNetGroupRegexPermission(BasePermission):
         data = validated_serializer.validated_data
         # If the ip
         if isinstance(view, (mreg.api.v1.views.HostList,
-                             mreg.api.v1.views.IpaddressList)):
+                             mreg.api.v1.views.IpaddressList,
+                             mreg.api.v1.views.NetworkAllocate)):
             # HostList does not require ipaddress, but if none, the permissions
             # will not match, so just refuse it.
             if 'ipaddress' not in data:
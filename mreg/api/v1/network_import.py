@@ -0,0 +1,69 @@
+import csv
+
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework import serializers
+from rest_framework.parsers import BaseParser
+
+from mreg.models import Network
+
+from .serializers import NetworkImportSerializer
+
+
+class NetworkOverlapError(Exception):
+
+    def __init__(self, overlaps):
+        self.overlaps = overlaps
+        super().__init__('Networks overlap: ' + ', '.join(
+            f'{new} with {other}' for new, other in overlaps))
+
+
+def read_csv(lines):
+    """Return the networks in CSV lines with a header line of field names.
+    Empty values are left out, to use the defaults."""
+    return [{key: value for key, value in row.items() if value}
+            for row in csv.DictReader(lines)]
+
+
+class CSVParser(BaseParser):
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        return read_csv(stream.read().decode(encoding).splitlines())
+
+
+def import_networks(rows):
+    """
+    Create networks from a list of dicts with the fields of each network.
+    All networks are created, or none if any of them are invalid or overlap
+    each other or existing networks.
+    Return the list of created networks.
+    """
+    if not isinstance(rows, list):
+        raise serializers.ValidationError('Expected a list of networks')
+    networks = []
+    errors = {}
+    for i, row in enumerate(rows, 1):
+        serializer = NetworkImportSerializer(data=row)
+        if not serializer.is_valid():
+            errors[f'network {i}'] = serializer.errors
+            continue
+        networks.append(serializer.create())
+    if errors:
+        raise serializers.ValidationError(errors)
+
+    with transaction.atomic():
+        # Keep other networks from being created until these are committed,
+        # so they are checked against all networks.
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {Network._meta.db_table} '
+                           'IN SHARE ROW EXCLUSIVE MODE')
+        overlaps = Network.find_overlaps([network.network for network in networks])
+        if overlaps:
+            raise NetworkOverlapError(overlaps)
+        networks = Network.objects.bulk_create(networks)
+    # bulk_create() does not send the post_save signals.
+    Network.prefix_index.invalidate()
+    return networks
@@ -10,7 +10,7 @@ from mreg.models import (Cname, HinfoPreset, Host, Ipaddress, Mx, NameServer,
                          NetGroupRegexPermission)
 
 from mreg.utils import nonify
-from mreg.validators import validate_keys
+from mreg.validators import validate_keys, validate_network
 
 
 class ValidationMixin:
@@ -147,7 +147,10 @@ class HostSerializer(ForwardZoneMixin, serializers.ModelSerializer):
         fields = '__all__'
 
     def get_ipaddresses(self, instance):
-        ipaddresses = instance.ipaddresses.all().order_by('ipaddress')
+        # Sorted here, like by the database, to use prefetched ipaddresses.
+        ipaddresses = sorted(instance.ipaddresses.all(),
+                             key=lambda i: (ipaddress.ip_address(i.ipaddress).version,
+                                            ipaddress.ip_address(i.ipaddress)))
         return IpaddressSerializer(ipaddresses, many=True, read_only=True).data
 
 
@@ -204,7 +207,20 @@ class NetworkSerializer(ValidationMixin, serializers.ModelSerializer):
         fields = '__all__'
 
     def create(self):
-        return Network(**self.validated_data)
+        network = Network(**self.validated_data)
+        # Changed the default value of reserved if the size of the network is too low
+        num_addresses = ipaddress.ip_network(network.range).num_addresses
+        if num_addresses <= 4:
+            network.reserved = min(2, num_addresses)
+        return network
+
+
+class NetworkImportSerializer(NetworkSerializer):
+    class Meta(NetworkSerializer.Meta):
+        # Duplicate ranges are found by Network.find_overlaps() for all the
+        # imported networks at once, instead of one query per network.
+        extra_kwargs = {'range': {'validators': [validate_network]}}
+
 
 class NetGroupRegexPermissionSerializer(ValidationMixin, serializers.ModelSerializer):
     class Meta:
@@ -1,16 +1,20 @@
+import os
+import tempfile
+
 from datetime import timedelta
 
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.contrib.auth.models import Group
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
 from django.utils import timezone
 from rest_framework.authtoken.models import Token
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 
 from mreg.models import (Cname, HinfoPreset, Host, Ipaddress, NameServer,
                          Naptr, PtrOverride, Srv, Network, Txt, ForwardZone,
-                         ReverseZone, ModelChangeLog, Sshfp)
+                         ForwardZoneDelegation, ReverseZone, ModelChangeLog, Sshfp)
 
 from mreg.utils import create_serialno
 
@@ -19,7 +23,7 @@ class MissingSettings(Exception):
     pass
 
 
-class MregAPITestCase(APITestCase):
+class MregAPITestCaseMixin:
 
     def setUp(self):
         self.client = self.get_token_client()
@@ -47,11 +51,69 @@ class MregAPITestCase(APITestCase):
             group.save()
 
 
+class MregAPITestCase(MregAPITestCaseMixin, APITestCase):
+    pass
+
+
+class MregAPITransactionTestCase(MregAPITestCaseMixin, APITransactionTestCase):
+    """For tests of changes done when a transaction is committed, which
+    never happens in a TestCase."""
+
+
 def clean_and_save(entity):
     entity.full_clean()
     entity.save()
 
 
+class CaptureQueries:
+    """
+    Context manager which records the SQL of the queries run in its block.
+
+    Used instead of CaptureQueriesContext, which records nothing here, as
+    django_logging replaces the debug cursor with one which only logs slow
+    queries.
+    """
+
+    def __init__(self):
+        self.captured_queries = []
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self._record)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+    def _record(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        sql = connection.ops.last_executed_query(context['cursor'], sql, params)
+        self.captured_queries.append({'sql': sql})
+        return result
+
+
+class ZonefileQueriesMixin:
+    """For tests of the number of queries used to generate a zonefile."""
+
+    def get_zonefile_queries(self, name):
+        """Return the number of queries used to generate the zonefile of the
+        zone, and the zonefile."""
+        with CaptureQueries() as queries:
+            response = self.client.get(f'/zonefiles/{name}')
+            content = b''.join(response.streaming_content).decode()
+        self.assertEqual(response.status_code, 200)
+        return len(queries), content
+
+
+def row_fetches(queries, table, pk):
+    """Returns the number of queries which fetched a row by its id."""
+    sql = f'FROM "{table}" WHERE "{table}"."id" = {pk} '
+    return sum(1 for query in queries.captured_queries if sql in query['sql'] + ' ')
+
+
 class APITokenAutheticationTestCase(MregAPITestCase):
     """Test various token authentication operations."""
 
@@ -75,7 +137,7 @@ class APITokenAutheticationTestCase(MregAPITestCase):
         self.assertEqual(ret.status_code, 401)
 
 
-class APIAutoupdateZonesTestCase(MregAPITestCase):
+class APIAutoupdateZonesTestCase(MregAPITransactionTestCase):
     """This class tests the autoupdate of zones' updated_at whenever
        various models are added/deleted/renamed/changed etc."""
 
@@ -134,6 +196,60 @@ class APIAutoupdateZonesTestCase(MregAPITestCase):
         self.assertGreater(self.zone_exampleorg.updated_at, old_org_updated_at)
         self.assertGreater(self.zone_1010.updated_at, old_1010_updated_at)
 
+    def test_zone_updated_once_per_transaction(self):
+        ForwardZone.objects.update(updated=False)
+        with CaptureQueries() as queries:
+            with transaction.atomic():
+                for i in range(10):
+                    clean_and_save(Host(name=f'host{i}.example.org',
+                                        contact='mail@example.org',
+                                        zone=self.zone_exampleorg))
+                self.zone_exampleorg.refresh_from_db()
+                self.assertFalse(self.zone_exampleorg.updated)
+        updates = [q for q in queries.captured_queries
+                   if q['sql'].startswith('UPDATE "forward_zone"')]
+        self.assertEqual(len(updates), 1)
+        self.zone_exampleorg.refresh_from_db()
+        self.assertTrue(self.zone_exampleorg.updated)
+
+    def test_record_change_keeps_prefix_index(self):
+        """Marking the zones as updated and bumping their serial numbers
+        does not change their ranges, so the prefix indexes are kept."""
+
+        def get_generation():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT generation FROM prefix_index_generation '
+                               'WHERE table_name = %s', ['reverse_zone'])
+                return cursor.fetchone()[0]
+
+        generation = get_generation()
+        ReverseZone.objects.update(updated=False)
+        ret = self.client.post('/hosts/', self.host1)
+        self.assertEqual(ret.status_code, 201)
+        self.zone_1010.refresh_from_db()
+        self.assertTrue(self.zone_1010.updated)
+        self.zone_1010.update_serialno(force=True)
+        self.assertEqual(get_generation(), generation)
+
+    def test_zone_not_updated_after_rollback(self):
+        ForwardZone.objects.update(updated=False)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                clean_and_save(Host(name='host1.example.org',
+                                    contact='mail@example.org',
+                                    zone=self.zone_exampleorg))
+                raise RuntimeError
+        # Commit an unrelated change, which must not mark the zone of the
+        # rolled back one.
+        with transaction.atomic():
+            clean_and_save(Host(name='host1.example.com',
+                                contact='mail@example.org',
+                                zone=self.zone_examplecom))
+        self.zone_exampleorg.refresh_from_db()
+        self.zone_examplecom.refresh_from_db()
+        self.assertFalse(self.zone_exampleorg.updated)
+        self.assertTrue(self.zone_examplecom.updated)
+
     def test_change_soa(self):
         self.zone_exampleorg.updated = False
         self.zone_exampleorg.save()
@@ -183,6 +299,77 @@ class APIAutoupdateZonesTestCase(MregAPITestCase):
         self.assertTrue(self.zone_exampleorg.updated)
 
 
+class APIHostHistoryTestCase(MregAPITransactionTestCase):
+    """This class tests that the host history is saved when committed."""
+
+    def setUp(self):
+        super().setUp()
+        self.host = Host(name='host1.example.org', contact='mail@example.org')
+        clean_and_save(self.host)
+
+    def _history(self):
+        return ModelChangeLog.objects.filter(table_name='host', table_row=self.host.id)
+
+    def test_one_snapshot_per_transaction(self):
+        with transaction.atomic():
+            clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.1'))
+            clean_and_save(Txt(host=self.host, txt='some text'))
+            clean_and_save(Cname(host=self.host, name='alias.example.org'))
+            self.assertEqual(self._history().count(), 0)
+        self.assertEqual(self._history().count(), 1)
+        entry = self._history().get()
+        self.assertEqual(entry.action, 'saved')
+        self.assertEqual(entry.data['ipaddresses'], ['10.0.0.1'])
+        self.assertEqual(entry.data['txts'], ['some text'])
+
+    def test_no_snapshot_on_rollback(self):
+        try:
+            with transaction.atomic():
+                clean_and_save(Txt(host=self.host, txt='some text'))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(self._history().count(), 0)
+        # Commit an unrelated change, which must not log the rolled back one.
+        host2 = Host(name='host2.example.org', contact='mail@example.org')
+        clean_and_save(host2)
+        with transaction.atomic():
+            clean_and_save(Txt(host=host2, txt='other text'))
+        self.assertEqual(self._history().count(), 0)
+        self.assertEqual(ModelChangeLog.objects.filter(table_name='host',
+                                                       table_row=host2.id).count(), 1)
+
+    def test_deleted(self):
+        txt = Txt(host=self.host, txt='some text')
+        clean_and_save(txt)
+        txt.delete()
+        self.assertEqual(list(self._history().order_by('id').values_list('action', flat=True)),
+                         ['saved', 'deleted'])
+
+    def test_host_deleted(self):
+        clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.1'))
+        history = self._history()
+        self.host.delete()
+        self.assertEqual(list(history.order_by('id').values_list('action', flat=True)),
+                         ['saved', 'deleted'])
+        response = self.client.get('/history/host/{}'.format(history.last().table_row))
+        self.assertEqual(response.data[-1]['data']['ipaddresses'], ['10.0.0.1'])
+
+    @override_settings(HOST_HISTORY_KEYFRAME_INTERVAL=3)
+    def test_deltas_between_keyframes(self):
+        for i in range(1, 6):
+            clean_and_save(Txt(host=self.host, txt='text {}'.format(i)))
+        entries = self._history().order_by('id')
+        self.assertEqual([entry.is_delta for entry in entries],
+                         [False, True, True, False, True])
+        self.assertEqual(list(entries[1].data), ['set'])
+        self.assertEqual(sorted(entries[1].data['set']['txts']), ['text 1', 'text 2'])
+        response = self.client.get('/history/host/{}'.format(self.host.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([len(entry['data']['txts']) for entry in response.data],
+                         [1, 2, 3, 4, 5])
+
+
 class APIAutoupdateHostZoneTestCase(MregAPITestCase):
     """This class tests that a Host's zone attribute is correct and updated
        when renaming etc.
@@ -352,6 +539,13 @@ class APIHostsTestCase(MregAPITestCase):
         self.assertEqual(response.status_code, 204)
         self.assertEqual(response['Location'], '/hosts/%s' % self.patch_data['name'])
 
+    def test_hosts_patch_does_not_refetch_host(self):
+        """Patching a host should not fetch it again to compare old and new values"""
+        with CaptureQueries() as queries:
+            response = self.client.patch('/hosts/%s' % self.host_one.name, self.patch_data)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(row_fetches(queries, 'host', self.host_one.id), 0)
+
     def test_hosts_patch_without_name_204_no_content(self):
         """Patching an existing entry without having name in patch should
         return 204"""
@@ -379,7 +573,7 @@ class APIHostsTestCase(MregAPITestCase):
         self.assertEqual(response.status_code, 409)
 
 
-class APIMxTestcase(MregAPITestCase):
+class APIMxTestcase(MregAPITransactionTestCase):
     """Test MX records."""
 
     def setUp(self):
@@ -449,7 +643,7 @@ class APIMxTestcase(MregAPITestCase):
         self.assertTrue(self.zone.updated)
 
 
-class APISshfpTestcase(MregAPITestCase):
+class APISshfpTestcase(MregAPITransactionTestCase):
     """Test SSHFP records."""
 
     def setUp(self):
@@ -523,7 +717,7 @@ class APISshfpTestcase(MregAPITestCase):
         self.assertTrue(self.zone.updated)
 
 
-class APIForwardZonesTestCase(MregAPITestCase):
+class APIForwardZonesTestCase(ZonefileQueriesMixin, MregAPITestCase):
     """"This class defines the test suite for forward zones API """
 
     def setUp(self):
@@ -627,8 +821,26 @@ class APIForwardZonesTestCase(MregAPITestCase):
         # TODO: jobb skal gjøres her
         """"Deleting an entry with registered entries should require force"""
 
-
-class APIZonesForwardDelegationTestCase(MregAPITestCase):
+    def _zonefile_queries(self, count):
+        hinfo, _ = HinfoPreset.objects.get_or_create(cpu='cpu', os='os')
+        Host.objects.bulk_create(
+            Host(name=f'host{i}.example.org', contact='mail@example.org',
+                 zone=self.zone_one, hinfo=hinfo, loc='52 22 23.000 N 4 53 32.000 E -2.00m')
+            for i in range(count))
+        queries, content = self.get_zonefile_queries('example.org')
+        self.assertEqual(content.count('HINFO  cpu os'), count)
+        self.assertIn('host0                          IN LOC    52 22 23.000 N', content)
+        return queries
+
+    def test_zonefile_hinfo_loc_constant_queries(self):
+        """The number of queries must not depend on the number of hosts."""
+        one = self._zonefile_queries(1)
+        self.assertGreater(one, 0)
+        Host.objects.filter(name__startswith='host').delete()
+        self.assertEqual(self._zonefile_queries(200), one)
+
+
+class APIZonesForwardDelegationTestCase(ZonefileQueriesMixin, MregAPITestCase):
     """ This class defines test testsuite for api/zones/<name>/delegations/
         But only for ForwardZones.
     """
@@ -659,6 +871,46 @@ class APIZonesForwardDelegationTestCase(MregAPITestCase):
         response = self.client.get('/zonefiles/example.org')
         self.assertEqual(response.status_code, 200)
 
+    def test_zonefile_is_streamed(self):
+        self.test_delegate_forward_201_ok()
+        response = self.client.get('/zonefiles/example.org')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('$ORIGIN example.org.', content)
+        self.assertIn('; Delegations', content)
+        self.assertIn('delegated', content)
+
+    def _zonefile_queries(self, count):
+        zone = ForwardZone.objects.get(name='example.org')
+        delegations = ForwardZoneDelegation.objects.bulk_create(
+            ForwardZoneDelegation(zone=zone, name=f'd{i}.example.org')
+            for i in range(count))
+        nameservers = NameServer.objects.bulk_create(
+            NameServer(name=f'ns.{d.name}') for d in delegations)
+        ForwardZoneDelegation.nameservers.through.objects.bulk_create(
+            ForwardZoneDelegation.nameservers.through(forwardzonedelegation=d,
+                                                      nameserver=ns)
+            for d, ns in zip(delegations, nameservers))
+        hosts = Host.objects.bulk_create(
+            Host(name=ns.name, contact='mail@example.org') for ns in nameservers)
+        Ipaddress.objects.bulk_create(
+            Ipaddress(host=host, ipaddress=f'10.0.{i // 256}.{i % 256}')
+            for i, host in enumerate(hosts))
+        queries, content = self.get_zonefile_queries('example.org')
+        self.assertIn('ns.d0', content)
+        self.assertIn('IN A      10.0.0.0', content)
+        return queries
+
+    def test_delegate_forward_glue_constant_queries(self):
+        """The number of queries must not depend on the number of delegations."""
+        one = self._zonefile_queries(1)
+        self.assertGreater(one, 0)
+        ForwardZoneDelegation.objects.all().delete()
+        Host.objects.filter(name__startswith='ns.d').delete()
+        NameServer.objects.filter(name__startswith='ns.d').delete()
+        self.assertEqual(self._zonefile_queries(500), one)
+
     def test_delegate_forward_badname_400_bad_request(self):
         path = "/zones/example.org/delegations/"
         bad = {'name': 'delegated.example.com',
@@ -728,6 +980,123 @@ class APIZonesForwardDelegationTestCase(MregAPITestCase):
         self.assertEqual(response.data['results'], [])
 
 
+class APIZoneFileCacheTestCase(MregAPITransactionTestCase):
+    """This class tests the cache of generated zonefiles."""
+
+    def setUp(self):
+        super().setUp()
+        self.cachedir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cachedir.cleanup)
+        override = override_settings(ZONEFILE_CACHE_DIR=self.cachedir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.zone = ForwardZone(name='example.org',
+                                primary_ns='ns1.example.org',
+                                email='hostmaster@example.org')
+        clean_and_save(self.zone)
+        ForwardZone.objects.filter(id=self.zone.id).update(updated=False)
+
+    def _get_zonefile(self):
+        response = self.client.get('/zonefiles/example.org')
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def _cached_serials(self, subdir=''):
+        path = os.path.join(self.cachedir.name, 'example.org', subdir)
+        return [i for i in os.listdir(path) if os.path.isfile(os.path.join(path, i))]
+
+    def test_zonefile_cached(self):
+        zonefile = self._get_zonefile()
+        self.assertEqual(self._cached_serials(), [str(self.zone.serialno)])
+        self.assertEqual(self._get_zonefile(), zonefile)
+
+    def test_zonefile_cache_unwritable(self):
+        """An unusable cache directory should not break the zonefile."""
+        path = os.path.join(self.cachedir.name, 'file')
+        open(path, 'w').close()
+        with override_settings(ZONEFILE_CACHE_DIR=os.path.join(path, 'cache')):
+            self.assertIn('SOA', self._get_zonefile())
+
+    def test_zonefile_cache_invalidated(self):
+        self._get_zonefile()
+        host = Host(name='host1.example.org', contact='mail@example.org',
+                    zone=self.zone)
+        clean_and_save(host)
+        clean_and_save(Ipaddress(host=host, ipaddress='10.0.0.1'))
+        self.assertEqual(self._cached_serials(), [])
+        self.assertEqual(self._cached_serials('snapshots'), [str(self.zone.serialno)])
+        self.assertIn('host1', self._get_zonefile())
+
+    def test_zonefile_cache_capped_serial(self):
+        """A changed zone must not be served from the cache when its serial
+        number can not be bumped, as it is the last one of the day."""
+        serialno = create_serialno() + 99
+        ForwardZone.objects.filter(id=self.zone.id).update(serialno=serialno)
+        self.assertIn('$TTL 43200', self._get_zonefile())
+        self.assertEqual(self._cached_serials(), [str(serialno)])
+        ret = self.client.patch('/zones/example.org', {'ttl': 1000})
+        self.assertEqual(ret.status_code, 204)
+        # Allow the serial number to be updated.
+        ForwardZone.objects.filter(id=self.zone.id).update(
+            serialno_updated_at=timezone.now() - timedelta(minutes=5))
+        zonefile = self._get_zonefile()
+        self.zone.refresh_from_db()
+        self.assertEqual(self.zone.serialno, serialno)
+        self.assertFalse(self.zone.updated)
+        self.assertIn('$TTL 1000', zonefile)
+        self.assertEqual(self._get_zonefile(), zonefile)
+
+    def test_zonefile_diff(self):
+        self._get_zonefile()
+        old_serialno = self.zone.serialno
+        host = Host(name='host1.example.org', contact='mail@example.org',
+                    zone=self.zone)
+        clean_and_save(host)
+        clean_and_save(Ipaddress(host=host, ipaddress='10.0.0.1'))
+        # Allow the serial number to be updated.
+        ForwardZone.objects.filter(id=self.zone.id).update(
+            serialno_updated_at=timezone.now() - timedelta(minutes=5))
+        response = self.client.get(f'/zonefiles/example.org/diff?from={old_serialno}')
+        self.assertEqual(response.status_code, 200)
+        self.zone.refresh_from_db()
+        self.assertEqual(response.data['from'], old_serialno)
+        self.assertEqual(response.data['to'], self.zone.serialno)
+        self.assertNotEqual(old_serialno, self.zone.serialno)
+        self.assertEqual(len(response.data['removed']), 1)
+        self.assertIn(' SOA ', response.data['removed'][0])
+        self.assertIn('host1.example.org. IN A 10.0.0.1', response.data['added'])
+        # Nothing changed since the current serial number
+        response = self.client.get(f'/zonefiles/example.org/diff?from={self.zone.serialno}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['removed'], [])
+        self.assertEqual(response.data['added'], [])
+
+    def test_zonefile_diff_unknown_serial(self):
+        response = self.client.get('/zonefiles/example.org/diff')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/zonefiles/example.org/diff?from=foo')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/zonefiles/example.org/diff?from=1')
+        self.assertEqual(response.status_code, 404)
+
+    def test_zonefile_conditional_get(self):
+        response = self.client.get('/zonefiles/example.org')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+        response = self.client.get('/zonefiles/example.org',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        host = Host(name='host1.example.org', contact='mail@example.org',
+                    zone=self.zone)
+        clean_and_save(host)
+        response = self.client.get('/zonefiles/example.org',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
 class APIZonesReverseDelegationTestCase(MregAPITestCase):
     """ This class defines test testsuite for api/zones/<name>/delegations/
         But only for ReverseZones.
@@ -1022,6 +1391,14 @@ class APIIPaddressesTestCase(MregAPITestCase):
         response = self.client.patch('/ipaddresses/%s' % self.ipaddress_one.id, self.patch_data_ip)
         self.assertEqual(response.status_code, 204)
 
+    def test_ipaddress_patch_does_not_refetch_ipaddress(self):
+        """Patching an ipaddress should only fetch it once"""
+        with CaptureQueries() as queries:
+            response = self.client.patch('/ipaddresses/%s' % self.ipaddress_one.id,
+                                         self.patch_data_ip)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(row_fetches(queries, 'ipaddress', self.ipaddress_one.id), 1)
+
     def test_ipaddress_patch_200_own_ip(self):
         """Patching an entry with its own ip should return 200"""
         response = self.client.patch('/ipaddresses/%s' % self.ipaddress_one.id,
@@ -1346,6 +1723,19 @@ class APINetworksTestCase(MregAPITestCase):
             'dns_delegated': 'False',
         }
 
+    def test_networks_filter_range(self):
+        """Filtering on the range should find the network, and reject values
+        which are not networks with 400"""
+        response = self.client.get('/networks/?range=10.0.0.0/24')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+        response = self.client.get('/networks/?range__contains=10.0.')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+        for query in ('range=10.0.0.0/8x', 'range=foo', 'range__in=10.0.0.0/24,foo'):
+            response = self.client.get(f'/networks/?{query}')
+            self.assertEqual(response.status_code, 400)
+
     def test_networks_post_201_created(self):
         """Posting a network should return 201"""
         response = self.client.post('/networks/', self.post_data)
@@ -1535,8 +1925,29 @@ class APINetworksTestCase(MregAPITestCase):
 
         response = self.client.get('/networks/%s/unused_count' % self.network_ipv6_sample.range)
         self.assertEqual(response.status_code, 200)
-        # Only the first 4000 addresses for IPv6 are returned, :1 and :2 and :3 are reserved
-        self.assertEqual(response.data, 3997)
+        # All of the /32 except the network address, :1, :2 and :3 which are
+        # reserved, and the used address.
+        self.assertEqual(response.data, 2**96 - 5)
+
+    def test_networks_get_utilization_200_ok(self):
+        """GET on /networks/utilization should return counts for all networks."""
+        clean_and_save(Ipaddress(host=self.host_one, ipaddress='10.0.0.17'))
+        # A reserved address is used, but not counted as unused
+        clean_and_save(Ipaddress(host=self.host_one, ipaddress='10.0.0.2'))
+        response = self.client.get('/networks/utilization')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), Network.objects.count())
+        data = {i['network']: i for i in response.data}
+        self.assertEqual(data['10.0.0.0/24']['size'], 256)
+        self.assertEqual(data['10.0.0.0/24']['reserved'], 5)
+        self.assertEqual(data['10.0.0.0/24']['used'], 2)
+        self.assertEqual(data['10.0.0.0/24']['unused'], 250)
+        self.assertEqual(data['2001:db8::/32']['unused'], 2**96 - 4)
+        response = self.client.get('/networks/utilization', {'vlan': 135})
+        self.assertEqual({i['network'] for i in response.data},
+                         {'10.0.1.0/28', '2001:db8:8000::/33'})
+        response = self.client.get('/networks/utilization', {'vlan': 'foo'})
+        self.assertEqual(response.status_code, 400)
 
     def test_networks_get_unusedlist_200_ok(self):
         """GET on /networks/<ip/mask>/unused_list should return 200 ok and data."""
@@ -1547,6 +1958,16 @@ class APINetworksTestCase(MregAPITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data), 250)
 
+    def test_networks_get_unusedlist_ipv4_not_paginated(self):
+        """GET on /networks/<ip/mask>/unused_list should return all unused IPv4
+        addresses unless limit or after is given."""
+        clean_and_save(Network(range='10.1.0.0/20', description='some description'))
+        response = self.client.get('/networks/10.1.0.0/20/unused_list')
+        self.assertEqual(response.status_code, 200)
+        # All except the network, broadcast and three reserved addresses
+        self.assertEqual(len(response.data), 4096 - 5)
+        self.assertNotIn('Link', response)
+
     def test_ipv6_networks_get_unusedlist_200_ok(self):
         """GET on /networks/<ipv6/mask>/unused_list should return 200 ok and data."""
         ipv6_sample = Ipaddress(host=self.host_one, ipaddress='2001:db8::beef')
@@ -1554,7 +1975,26 @@ class APINetworksTestCase(MregAPITestCase):
 
         response = self.client.get('/networks/%s/unused_list' % self.network_ipv6_sample.range)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 3997)
+        # The first page, starting after the reserved :1, :2 and :3
+        self.assertEqual(len(response.data), 4000)
+        self.assertEqual(response.data[0], '2001:db8::4')
+        self.assertIn('after=2001%3Adb8%3A%3Afa3', response['Link'])
+
+    def test_networks_get_unusedlist_paginated(self):
+        """GET on /networks/<ip/mask>/unused_list should support limit and after."""
+        clean_and_save(Ipaddress(host=self.host_one, ipaddress='10.0.0.6'))
+        path = '/networks/%s/unused_list' % self.network_sample.range
+        response = self.client.get(path, {'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, ['10.0.0.4', '10.0.0.5', '10.0.0.7'])
+        self.assertIn('after=10.0.0.7', response['Link'])
+        response = self.client.get(path, {'limit': 3, 'after': '10.0.0.252'})
+        self.assertEqual(response.data, ['10.0.0.253', '10.0.0.254'])
+        self.assertNotIn('Link', response)
+        response = self.client.get(path, {'limit': 0})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(path, {'after': '2001:db8::1'})
+        self.assertEqual(response.status_code, 400)
 
     def test_networks_get_first_unused_200_ok(self):
         """GET on /networks/<ip/mask>/first_unused should return 200 ok and data."""
@@ -1565,6 +2005,88 @@ class APINetworksTestCase(MregAPITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data, '10.0.0.4')
 
+    def test_networks_get_first_unused_after_used_run(self):
+        """first_unused should skip a run of used addresses"""
+        for ip in ('10.0.0.4', '10.0.0.5', '10.0.0.6', '10.0.0.8'):
+            clean_and_save(Ipaddress(host=self.host_one, ipaddress=ip))
+        response = self.client.get('/networks/%s/first_unused' % self.network_sample.range)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, '10.0.0.7')
+
+    def test_networks_get_first_unused_404_when_full(self):
+        """first_unused should return 404 when the network is full"""
+        # 10.0.1.0/28 has 14 hosts, the first 3 reserved
+        for i in range(4, 15):
+            clean_and_save(Ipaddress(host=self.host_one, ipaddress=f'10.0.1.{i}'))
+        response = self.client.get('/networks/%s/first_unused' % self.network_sample_two.range)
+        self.assertEqual(response.status_code, 404)
+
+    def test_networks_allocate_201_created(self):
+        """POST on /networks/<ip/mask>/allocate should create the first unused ipaddress"""
+        path = '/networks/%s/allocate' % self.network_sample.range
+        response = self.client.post(path, {'host': self.host_one.id})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['ipaddress'], '10.0.0.4')
+        self.assertEqual(response['Location'], '/ipaddresses/%s' % response.data['id'])
+        response = self.client.post(path, {'host': self.host_one.id})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['ipaddress'], '10.0.0.5')
+        self.assertEqual(Ipaddress.objects.filter(host=self.host_one).count(), 2)
+
+    def test_networks_allocate_404_when_full(self):
+        """POST on /networks/<ip/mask>/allocate should return 404 when the network is full"""
+        for i in range(4, 15):
+            clean_and_save(Ipaddress(host=self.host_one, ipaddress=f'10.0.1.{i}'))
+        path = '/networks/%s/allocate' % self.network_sample_two.range
+        response = self.client.post(path, {'host': self.host_one.id})
+        self.assertEqual(response.status_code, 404)
+
+    def test_networks_allocate_400_bad_request(self):
+        """POST on /networks/<ip/mask>/allocate without a host should return 400"""
+        response = self.client.post('/networks/%s/allocate' % self.network_sample.range, {})
+        self.assertEqual(response.status_code, 400)
+
+    def test_networks_import_json_201_created(self):
+        """POST on /networks/import with a JSON list should create the networks"""
+        data = [{'range': '10.1.0.0/24', 'vlan': 10, 'category': 'imported'},
+                {'range': '10.1.1.0/30'},
+                {'range': '2001:db9::/64', 'description': 'IPv6'}]
+        response = self.client.post('/networks/import', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'created': 3})
+        self.assertEqual(Network.objects.get(range='10.1.0.0/24').vlan, 10)
+        self.assertEqual(Network.objects.get(range='10.1.1.0/30').reserved, 2)
+        self.assertEqual(Network.get_network_by_ip('2001:db9::1').description, 'IPv6')
+
+    def test_networks_import_csv_201_created(self):
+        """POST on /networks/import with CSV should create the networks"""
+        data = ('range,description,vlan\n'
+                '10.1.0.0/24,first,10\n'
+                '10.1.1.0/24,,\n')
+        response = self.client.post('/networks/import', data, content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'created': 2})
+        self.assertIsNone(Network.objects.get(range='10.1.1.0/24').vlan)
+
+    def test_networks_import_409_conflict(self):
+        """POST on /networks/import should create nothing if any networks overlap"""
+        old_count = Network.objects.count()
+        data = [{'range': '10.1.0.0/24'}, {'range': '10.0.0.128/25'}]
+        response = self.client.post('/networks/import', data, format='json')
+        self.assertEqual(response.status_code, 409)
+        data = [{'range': '10.1.0.0/24'}, {'range': '10.1.0.0/16'}]
+        response = self.client.post('/networks/import', data, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Network.objects.count(), old_count)
+
+    def test_networks_import_400_bad_request(self):
+        """POST on /networks/import should create nothing if any networks are invalid"""
+        old_count = Network.objects.count()
+        data = [{'range': '10.1.0.0/24'}, {'range': '10.1.1.1/24'}]
+        response = self.client.post('/networks/import', data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Network.objects.count(), old_count)
+
     def test_ipv6_networks_get_first_unused_200_ok(self):
         """GET on /networks/<ipv6/mask>/first_unused should return 200 ok and data."""
         ipv6_sample = Ipaddress(host=self.host_one, ipaddress='2001:db8::beef')
@@ -1685,3 +2207,19 @@ class APIModelChangeLogsTestCase(MregAPITestCase):
         response = self.client.get('/history/hosts/{}'.format(self.host_one.id))
         self.assertEqual(response.status_code, 200)
         self.assertIsInstance(response.data, list)
+
+    def test_history_tables_distinct(self):
+        """Get on /history/ should list each table name once"""
+        for table_name in ('hosts', 'hosts', 'zones'):
+            clean_and_save(ModelChangeLog(table_name=table_name,
+                                          table_row=self.host_one.id,
+                                          data=self.log_data,
+                                          action='saved',
+                                          timestamp=timezone.now()))
+        response = self.client.get('/history/')
+        self.assertEqual(sorted(response.data), ['hosts', 'zones'])
+
+    def test_history_host_data_is_decoded(self):
+        """Get on /history/hosts/<pk> should return the data as an object"""
+        response = self.client.get('/history/hosts/{}'.format(self.host_one.id))
+        self.assertEqual(response.data[0]['data'], self.log_data)
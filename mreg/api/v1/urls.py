@@ -30,7 +30,10 @@ urlpatterns = [
     path('srvs/<pk>', views.SrvDetail.as_view()),
     path('networks/', views.NetworkList.as_view()),
     path('networks/ip/<ip>', views.network_by_ip),
+    path('networks/import', views.NetworkImport.as_view()),
+    path('networks/utilization', views.network_utilization),
     path('networks/<ip>/<range>', views.NetworkDetail.as_view()),
+    path('networks/<ip>/<range>/allocate', views.NetworkAllocate.as_view()),
     path('networks/<ip>/<range>/first_unused', views.network_first_unused),
     path('networks/<ip>/<range>/ptroverride_list', views.network_ptroverride_list),
     path('networks/<ip>/<range>/ptroverride_host_list', views.network_ptroverride_host_list),
@@ -47,6 +50,7 @@ urlpatterns = [
     re_path(r'^zones/(?P<name>(\d+/)?[^/]+)/delegations/$', views.ZoneDelegationList.as_view()),
     re_path(r'^zones/(?P<name>(\d+/)?[^/]+)/delegations/(?P<delegation>(.*))', views.ZoneDelegationDetail.as_view()),
     re_path(r'^zones/(?P<name>(\d+/)?[^/]+)/nameservers$', views.ZoneNameServerDetail.as_view()),
+    re_path(r'^zonefiles/(?P<name>(\d+/)?[^/]+)/diff$', views.ZoneFileDiff.as_view()),
     re_path(r'^zonefiles/(?P<name>(\d+/)?[^/]+)', views.ZoneFileDetail.as_view()),
     path('permissions/netgroupregex/', views.NetGroupRegexPermissionList.as_view()),
     path('permissions/netgroupregex/<pk>', views.NetGroupRegexPermissionDetail.as_view()),
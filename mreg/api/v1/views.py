@@ -1,16 +1,21 @@
-import bisect
+import io
 import ipaddress
+import itertools
 
 from collections import defaultdict
+from urllib.parse import urlencode
 
 import django.core.exceptions
 
 from django.db import transaction
-from django.http import Http404
+from django.http import FileResponse, Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from rest_framework import (filters, generics, renderers, status)
 from rest_framework.decorators import api_view
-from rest_framework.exceptions import ParseError, MethodNotAllowed
+from rest_framework.exceptions import MethodNotAllowed, NotFound, ParseError
+from rest_framework.parsers import JSONParser
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -32,11 +37,35 @@ from mreg.models import (Cname, ForwardZone, ForwardZoneDelegation, HinfoPreset,
                          Mx, NameServer, Naptr, Network, PtrOverride, ReverseZone,
                          ReverseZoneDelegation, Srv, Txt, ModelChangeLog, Sshfp)
 import mreg.models
+from mreg import history
 
-from .zonefile import ZoneFile
+from .network_import import CSVParser, NetworkOverlapError, import_networks
+from .zonefile import ZoneFile, ZoneFileCache, diff_zonefiles
 
 
 # These filtersets are used for applying generic filtering to all objects.
+class CidrFilterSetMixin:
+    """
+    Rejects filter values which are not networks for the lookups comparing
+    them with the range column, as the database can not cast them to cidr.
+    """
+
+    cidr_lookups = ('exact', 'in', 'gt', 'gte', 'lt', 'lte')
+
+    def filter(self):
+        for key, values in self.data.lists():
+            name, _, lookup = key.rstrip('!').partition('__')
+            if name != 'range' or (lookup or 'exact') not in self.cidr_lookups:
+                continue
+            for value in values:
+                for network in value.split(',') if lookup == 'in' else (value, ):
+                    try:
+                        ipaddress.ip_network(network)
+                    except ValueError:
+                        raise ParseError(detail=f"Invalid network: {network}")
+        return super().filter()
+
+
 class CnameFilterSet(ModelFilterSet):
     class Meta:
         model = Cname
@@ -87,7 +116,7 @@ class MxFilterSet(ModelFilterSet):
         model = Mx
 
 
-class NetworkFilterSet(ModelFilterSet):
+class NetworkFilterSet(CidrFilterSetMixin, ModelFilterSet):
     class Meta:
         model = Network
 
@@ -97,7 +126,7 @@ class TxtFilterSet(ModelFilterSet):
         model = Txt
 
 
-class NetGroupRegexPermissionFilterSet(ModelFilterSet):
+class NetGroupRegexPermissionFilterSet(CidrFilterSetMixin, ModelFilterSet):
     class Meta:
         model = mreg.models.NetGroupRegexPermission
 
@@ -112,7 +141,7 @@ class ForwardZoneDelegationFilterSet(ModelFilterSet):
         model = ForwardZoneDelegation
 
 
-class ReverseZoneFilterSet(ModelFilterSet):
+class ReverseZoneFilterSet(CidrFilterSetMixin, ModelFilterSet):
     class Meta:
         model = ReverseZone
 
@@ -179,7 +208,7 @@ class HostPermissionsUpdateDestroy:
                 self.permission_denied(request)
 
 
-class HostPermissionsListCreateAPIView(generics.ListCreateAPIView):
+class HostPermissionsCreate:
 
     # permission_classes = settings.MREG_PERMISSION_CLASSES
     permission_classes = (IsGrantedNetGroupRegexPermission, )
@@ -197,6 +226,11 @@ class HostPermissionsListCreateAPIView(generics.ListCreateAPIView):
                 self.permission_denied(request)
 
 
+class HostPermissionsListCreateAPIView(HostPermissionsCreate,
+                                       generics.ListCreateAPIView):
+    pass
+
+
 class CnameList(HostPermissionsListCreateAPIView):
     """
     get:
@@ -619,13 +653,9 @@ class NetworkList(generics.ListCreateAPIView):
         error = _overlap_check(request.data['range'])
         if error:
             return error
-        ip_network = ipaddress.ip_network(request.data['range'])
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         network = serializer.create()
-        # Changed the default value of reserved if the size of the network is too low
-        if ip_network.num_addresses <= 4:
-            network.reserved = min(2, ip_network.num_addresses)
         self.perform_create(network)
         location = '/networks/%s' % request.data
         return Response(status=status.HTTP_201_CREATED, headers={'Location': location})
@@ -680,13 +710,50 @@ class NetworkDetail(MregRetrieveUpdateDestroyAPIView):
 
     def delete(self, request, *args, **kwargs):
         network = self.get_object()
-        used_ipaddresses = network.get_used_ipaddresses()
-        if used_ipaddresses:
+        if network._get_used_ipaddresses().exists():
             return Response({'ERROR': 'Network contains IP addresses that are in use'}, status=status.HTTP_409_CONFLICT)
 
         self.perform_destroy(network)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+
+class NetworkImport(generics.GenericAPIView):
+    """
+    post:
+    Create many networks at once, from a JSON list of networks or CSV with a
+    header line of field names. None of the networks are created if any are
+    invalid, or overlap each other or existing networks.
+    """
+    parser_classes = (JSONParser, CSVParser)
+    permission_classes = (IsSuperGroupMember, )
+
+    def post(self, request, *args, **kwargs):
+        try:
+            networks = import_networks(request.data)
+        except NetworkOverlapError as error:
+            return Response({'ERROR': str(error)}, status=status.HTTP_409_CONFLICT)
+        return Response({'created': len(networks)}, status=status.HTTP_201_CREATED)
+
+
+@api_view()
+def network_utilization(request, *args, **kwargs):
+    """
+    Returns the size and the number of reserved, used and unused addresses
+    for all networks, optionally filtered by category, location or vlan.
+    """
+    networks = Network.objects.all()
+    for field in ('category', 'location', 'vlan'):
+        if field in request.query_params:
+            value = request.query_params[field]
+            if field == 'vlan':
+                try:
+                    value = int(value)
+                except ValueError as error:
+                    raise ParseError(detail=str(error))
+            networks = networks.filter(**{field: value})
+    return Response(list(Network.get_utilization(networks)), status=status.HTTP_200_OK)
+
+
 @api_view()
 def network_by_ip(request, *args, **kwargs):
     try:
@@ -701,6 +768,36 @@ def network_by_ip(request, *args, **kwargs):
         raise Http404
 
 
+class NetworkAllocate(HostPermissionsCreate, generics.GenericAPIView):
+    """
+    post:
+    Creates a new ipaddress object with the first unused ipaddress on the
+    network. Requires an existing host. Allocations on the same network are
+    done one at a time, so concurrent requests never get the same address.
+    """
+
+    serializer_class = IpaddressSerializer
+
+    def post(self, request, *args, **kwargs):
+        iprange = _get_iprange(kwargs)
+        data = request.data.copy()
+        with transaction.atomic():
+            # Lock the network until the new ipaddress is committed.
+            network = get_object_or_404(Network.objects.select_for_update(),
+                                        range=iprange)
+            ip = network.get_first_unused()
+            if ip is None:
+                content = {'ERROR': 'No available IPs'}
+                return Response(content, status=status.HTTP_404_NOT_FOUND)
+            data['ipaddress'] = ip
+            serializer = self.get_serializer(data=data)
+            serializer.is_valid(raise_exception=True)
+            self.perform_create(serializer)
+        location = '/ipaddresses/%s' % serializer.instance.id
+        return Response(serializer.data, status=status.HTTP_201_CREATED,
+                        headers={'Location': location})
+
+
 @api_view()
 def network_first_unused(request, *args, **kwargs):
     network = _get_network(kwargs)
@@ -729,8 +826,8 @@ def network_ptroverride_list(request, *args, **kwargs):
 def network_ptroverride_host_list(request, *args, **kwargs):
     ptrs = _network_ptroverride_list(kwargs)
     ret = dict()
-    info =  ptrs.values_list('host__name', 'ipaddress')
-    for host, ip in sorted(info, key=lambda i: ipaddress.ip_address(i[1])):
+    info =  ptrs.order_by('ipaddress').values_list('host__name', 'ipaddress')
+    for host, ip in info:
         ret[ip] = host
     return Response(ret, status=status.HTTP_200_OK)
 
@@ -738,7 +835,7 @@ def network_ptroverride_host_list(request, *args, **kwargs):
 @api_view()
 def network_reserved_list(request, *args, **kwargs):
     network = _get_network(kwargs)
-    reserved = list(map(str, sorted(network.get_reserved_ipaddresses())))
+    reserved = list(map(str, network.get_reserved_ipaddresses()))
     return Response(reserved, status=status.HTTP_200_OK)
 
 
@@ -751,7 +848,7 @@ def network_used_count(request, *args, **kwargs):
 @api_view()
 def network_used_list(request, *args, **kwargs):
     network = _get_network(kwargs)
-    used_ipaddresses = list(map(str, sorted(network.get_used_ipaddresses())))
+    used_ipaddresses = list(map(str, network.get_used_ipaddresses()))
     return Response(used_ipaddresses, status=status.HTTP_200_OK)
 
 
@@ -759,24 +856,64 @@ def network_used_list(request, *args, **kwargs):
 def network_used_host_list(request, *args, **kwargs):
     network = _get_network(kwargs)
     ret = defaultdict(list)
-    info =  network._get_used_ipaddresses().values_list('host__name', 'ipaddress')
-    for host, ip in sorted(info, key=lambda i: ipaddress.ip_address(i[1])):
-        bisect.insort(ret[ip], host)
+    info =  network._get_used_ipaddresses().order_by('ipaddress', 'host__name')
+    for host, ip in info.values_list('host__name', 'ipaddress'):
+        ret[ip].append(host)
     return Response(ret, status=status.HTTP_200_OK)
 
 
 @api_view()
 def network_unused_count(request, *args, **kwargs):
     network = _get_network(kwargs)
-    unused_ipaddresses = network.get_unused_ipaddresses()
-    return Response(len(unused_ipaddresses), status=status.HTTP_200_OK)
+    return Response(network.get_unused_ipaddress_count(), status=status.HTTP_200_OK)
+
+
+# Default and maximum number of addresses returned by network_unused_list,
+# when paginated.
+UNUSED_LIST_LIMIT = 4000
+UNUSED_LIST_MAX_LIMIT = 65536
 
 
 @api_view()
 def network_unused_list(request, *args, **kwargs):
+    """
+    Returns the unused addresses on the network in order. At most "limit"
+    addresses are returned, starting after the address "after" if given. A
+    Link header with rel="next" is returned if there are more addresses.
+
+    IPv4 networks are returned in full, unless limit or after is given.
+    """
     network = _get_network(kwargs)
-    unused_ipaddresses = list(map(str, sorted(network.get_unused_ipaddresses())))
-    return Response(unused_ipaddresses, status=status.HTTP_200_OK)
+    limit = request.query_params.get('limit')
+    after = request.query_params.get('after')
+    if limit is None and after is None and network.network.version == 4:
+        unused = network.get_unused_ipaddresses()
+        return Response(list(map(str, unused)), status=status.HTTP_200_OK)
+    try:
+        limit = int(limit or UNUSED_LIST_LIMIT)
+    except ValueError as error:
+        raise ParseError(detail=str(error))
+    if not 0 < limit <= UNUSED_LIST_MAX_LIMIT:
+        raise ParseError(detail=f"limit must be between 1 and {UNUSED_LIST_MAX_LIMIT}")
+    if after is not None:
+        try:
+            after = ipaddress.ip_address(after)
+        except ValueError as error:
+            raise ParseError(detail=str(error))
+        if after.version != network.network.version:
+            raise ParseError(detail=f"after must be an IPv{network.network.version} address")
+    unused = network.get_unused_ipaddresses(after=after)
+    try:
+        unused_ipaddresses = list(map(str, itertools.islice(unused, limit + 1)))
+    finally:
+        unused.close()
+    headers = {}
+    if len(unused_ipaddresses) > limit:
+        unused_ipaddresses.pop()
+        query = urlencode({'after': unused_ipaddresses[-1], 'limit': limit})
+        url = request.build_absolute_uri(f'{request.path}?{query}')
+        headers['Link'] = f'<{url}>; rel="next"'
+    return Response(unused_ipaddresses, status=status.HTTP_200_OK, headers=headers)
 
 
 class TxtList(HostPermissionsListCreateAPIView):
@@ -1140,7 +1277,7 @@ class ModelChangeLogList(generics.ListAPIView):
 
     def get(self, request, *args, **kwargs):
         # Return a list of available tables there are logged histories for.
-        tables = list(set([value['table_name'] for value in self.queryset.values('table_name')]))
+        tables = ModelChangeLog.get_table_names()
         return Response(data=tables, status=status.HTTP_200_OK)
 
 
@@ -1159,8 +1296,10 @@ class ModelChangeLogDetail(generics.RetrieveAPIView):
         query_table = self.kwargs['table']
         query_row = self.kwargs['pk']
         try:
-            logs_by_date = [vals for vals in self.queryset.filter(table_name=query_table,
-                                                                  table_row=query_row).order_by('timestamp').values()]
+            # Restore the data of the deltas in the order they were saved.
+            logs = history.restore(self.queryset.filter(table_name=query_table,
+                                                        table_row=query_row).order_by('id').values())
+            logs_by_date = sorted(logs, key=lambda log: log['timestamp'])
 
             return Response(logs_by_date, status=status.HTTP_200_OK)
         except ModelChangeLog.DoesNotExist:
@@ -1249,7 +1388,10 @@ class ZoneFileDetail(generics.GenericAPIView):
     All models should have a zf_string method that outputs its relevant data.
 
     get:
-    Generate zonefile for a given zone.
+    Generate zonefile for a given zone. The zonefile is streamed to the
+    client while it is generated. If the zone is unchanged since its serial
+    number was last updated, a cached copy of the zonefile is returned.
+    Supports conditional requests with If-None-Match and If-Modified-Since.
     """
 
     renderer_classes = (PlainTextRenderer, )
@@ -1264,9 +1406,76 @@ class ZoneFileDetail(generics.GenericAPIView):
             self.queryset = ForwardZone.objects.all()
         return super().get_queryset()
 
+    @staticmethod
+    def _validators(zone):
+        """Return the ETag and Last-Modified for the zone's zonefile.
+
+        Both are derived from the zone row alone, so a conditional request can
+        be answered without generating the zonefile. The zonefile header
+        includes updated_at, and updated_at is bumped whenever anything in the
+        zone changes, even if the serial number is not, so it is included too.
+        """
+        etag = quote_etag(f"{zone.serialno}-{zone.updated_at.timestamp():.6f}")
+        last_modified = int(max(zone.serialno_updated_at, zone.updated_at).timestamp())
+        return etag, last_modified
+
     def get(self, request, *args, **kwargs):
         zone = self.get_object()
         # XXX: a force argument to force serialno update?
         zone.update_serialno()
+        etag, last_modified = self._validators(zone)
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=last_modified)
+        if response is None:
+            response = self._get_zonefile_response(zone)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    @staticmethod
+    def _get_zonefile_response(zone):
+        content_type = 'text/plain; charset=utf-8'
+        cache = ZoneFileCache()
+        cached = cache.get(zone)
+        if cached is not None:
+            return FileResponse(cached, content_type=content_type)
         zonefile = ZoneFile(zone)
-        return Response(zonefile.generate())
+        return StreamingHttpResponse(cache.stream(zone, zonefile.stream()),
+                                     content_type=content_type)
+
+
+class ZoneFileDiff(ZoneFileDetail):
+    """
+    get:
+    Return the records removed from and added to the zone since the serial
+    number given with the "from" parameter, e.g. ?from=2019010100. Requires
+    that the zonefile for that serial number is still kept as a snapshot in
+    the zonefile cache.
+    """
+
+    renderer_classes = (JSONRenderer, )
+
+    def get(self, request, *args, **kwargs):
+        if 'from' not in request.query_params:
+            raise ParseError(detail="Missing parameter: from")
+        try:
+            serialno = int(request.query_params['from'])
+        except ValueError:
+            raise ParseError(detail="Parameter from must be a serial number")
+        zone = self.get_object()
+        zone.update_serialno()
+        cache = ZoneFileCache()
+        old = cache.get_snapshot(zone, serialno)
+        if old is None:
+            raise NotFound(detail=f"No snapshot of serial number {serialno}")
+        with io.TextIOWrapper(old, encoding='utf-8') as old:
+            current = cache.get(zone)
+            if current is None:
+                new = "".join(cache.stream(zone, ZoneFile(zone).stream()))
+                new = new.splitlines()
+                removed, added = diff_zonefiles(old, new)
+            else:
+                with io.TextIOWrapper(current, encoding='utf-8') as new:
+                    removed, added = diff_zonefiles(old, new)
+        return Response({'from': serialno, 'to': zone.serialno,
+                         'removed': removed, 'added': added})
@@ -1,11 +1,242 @@
 import ipaddress
+import logging
+import os
+import re
+import tempfile
 
-from collections import defaultdict
+from collections import Counter, defaultdict
+from urllib.parse import quote
 
-from mreg.models import Cname, ForwardZone, Host, Ipaddress, Mx, Naptr, Sshfp, Srv, Txt
+from django.conf import settings
+
+from mreg.models import (Cname, ForwardZone, HinfoPreset, Host, Ipaddress, Mx, Naptr,
+                         NameServer, Sshfp, Srv, Txt)
 from mreg.utils import clear_none, idna_encode, qualify
 
 
+logger = logging.getLogger(__name__)
+
+
+# Minimum size of each chunk yielded by ZoneFile.stream(). Joining the many
+# small record strings into larger chunks keeps the number of writes to the
+# client down, while the memory use stays flat regardless of zone size.
+CHUNK_SIZE = 64 * 1024
+
+
+def _chunked(iterable, chunk_size):
+    """Join the strings from iterable into chunks of at least chunk_size."""
+    buf = []
+    size = 0
+    for data in iterable:
+        buf.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield "".join(buf)
+
+
+class AtomicFile:
+    """A temporary file in the same directory as path, which replaces path
+    when committed, or is removed when discarded."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, self.tmppath = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            os.chmod(self.tmppath, 0o644)
+            self.file = os.fdopen(fd, 'w', encoding='utf-8')
+        except BaseException:
+            os.close(fd)
+            self._unlink()
+            raise
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        try:
+            self.file.close()
+            os.replace(self.tmppath, self.path)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self._unlink()
+
+    def _unlink(self):
+        try:
+            os.unlink(self.tmppath)
+        except OSError:
+            pass
+
+
+def write_atomic(path, chunks):
+    """Write the chunks to path, yielding each chunk after it is written.
+
+    The data is written to a temporary file in the same directory, which
+    replaces path once all chunks are written. If the writing is aborted,
+    e.g. by closing the generator, the temporary file is removed and path
+    is left untouched.
+    """
+    f = AtomicFile(path)
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+    except BaseException:
+        f.discard()
+        raise
+    f.commit()
+
+
+class ZoneFileCache:
+    """
+    On-disk cache of generated zonefiles, keyed on zone name and serial
+    number. A cached zonefile is only used while the zone has not been
+    updated since its serial number was set, and it is retired when the
+    zone or a record in it changes.
+
+    Retired zonefiles are kept as snapshots of earlier serial numbers, so
+    that the changes since a serial number can be found. The number of
+    snapshots to keep per zone is set with ZONEFILE_CACHE_SNAPSHOTS.
+
+    The cache directory is set with the setting ZONEFILE_CACHE_DIR, and the
+    cache is disabled if it is unset. Errors reading or writing the cache
+    are logged, and the zonefiles are then generated as if not cached.
+    """
+
+    def __init__(self, directory=None, snapshots=None):
+        if directory is None:
+            directory = getattr(settings, 'ZONEFILE_CACHE_DIR', None)
+        if snapshots is None:
+            snapshots = getattr(settings, 'ZONEFILE_CACHE_SNAPSHOTS', 10)
+        self.directory = directory
+        self.snapshots = snapshots
+
+    def _zonedir(self, name):
+        # Quote the name, as RFC 2317 zone names contain slashes.
+        return os.path.join(self.directory, quote(name, safe=''))
+
+    def _snapshotdir(self, name):
+        return os.path.join(self._zonedir(name), 'snapshots')
+
+    def _path(self, zone):
+        return os.path.join(self._zonedir(zone.name), str(zone.serialno))
+
+    def _usable(self, zone):
+        return bool(self.directory) and not zone.updated
+
+    def get(self, zone):
+        """Return an open file with the cached zonefile, or None."""
+        if not self._usable(zone):
+            return None
+        try:
+            return open(self._path(zone), 'rb')
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning('Could not read cached zonefile for %s: %s', zone.name, e)
+            return None
+
+    def get_snapshot(self, zone, serialno):
+        """Return an open file with the zonefile as it was for serialno,
+        or None."""
+        if not self.directory:
+            return None
+        for directory in (self._zonedir(zone.name), self._snapshotdir(zone.name)):
+            try:
+                return open(os.path.join(directory, str(serialno)), 'rb')
+            except FileNotFoundError:
+                pass
+        return None
+
+    def stream(self, zone, chunks):
+        """Yield the zonefile chunks, and store them in the cache if the zone
+        is not updated since the serial number was set."""
+        if not self._usable(zone):
+            yield from chunks
+            return
+        path = self._path(zone)
+        try:
+            f = AtomicFile(path)
+        except OSError as e:
+            logger.warning('Could not cache zonefile for %s: %s', zone.name, e)
+            yield from chunks
+            return
+        try:
+            for chunk in chunks:
+                if f is not None:
+                    try:
+                        f.write(chunk)
+                    except OSError as e:
+                        # Keep streaming the zonefile, but do not cache it.
+                        logger.warning('Could not cache zonefile for %s: %s', zone.name, e)
+                        f.discard()
+                        f = None
+                yield chunk
+        except BaseException:
+            if f is not None:
+                f.discard()
+            raise
+        if f is None:
+            return
+        try:
+            f.commit()
+            # Only the latest serial number will ever be served again.
+            self._retire(zone.name, keep=os.path.basename(path))
+        except OSError as e:
+            logger.warning('Could not cache zonefile for %s: %s', zone.name, e)
+
+    def invalidate(self, zone):
+        """Retire all cached zonefiles for the zone to snapshots."""
+        if self.directory:
+            try:
+                self._retire(zone.name)
+            except OSError as e:
+                logger.warning('Could not invalidate cached zonefiles for %s: %s',
+                               zone.name, e)
+
+    def _retire(self, name, keep=None):
+        zonedir = self._zonedir(name)
+        snapshotdir = self._snapshotdir(name)
+        try:
+            entries = os.listdir(zonedir)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry == keep or not entry.isdigit():
+                continue
+            path = os.path.join(zonedir, entry)
+            try:
+                if self.snapshots:
+                    os.makedirs(snapshotdir, exist_ok=True)
+                    os.replace(path, os.path.join(snapshotdir, entry))
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+        try:
+            snapshots = sorted((i for i in os.listdir(snapshotdir) if i.isdigit()),
+                               key=int, reverse=True)
+        except FileNotFoundError:
+            return
+        for entry in snapshots[self.snapshots:]:
+            try:
+                os.unlink(os.path.join(snapshotdir, entry))
+            except FileNotFoundError:
+                pass
+
+
 class ZoneFile:
     def __init__(self, zone):
         if zone.name.endswith('.in-addr.arpa'):
@@ -16,13 +247,116 @@ class ZoneFile:
             self.zonetype = ForwardFile(zone)
 
     def generate(self):
-        return self.zonetype.generate()
+        """Return the complete zonefile as a string."""
+        return "".join(self.zonetype.generate())
+
+    def stream(self, chunk_size=CHUNK_SIZE):
+        """Lazily generate the zonefile, in chunks of about chunk_size."""
+        return _chunked(self.zonetype.generate(), chunk_size)
+
+
+# Record types where the last field of the record data is a domain name.
+NAME_RDATA_TYPES = ('CNAME', 'MX', 'NAPTR', 'NS', 'PTR', 'SRV')
+
+RDATA_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+
+
+def _split_rdata(rdata):
+    # Normalize whitespace, but not inside quoted strings.
+    return RDATA_TOKEN_RE.findall(rdata)
+
+
+def parse_zonefile(lines):
+    """Yield each record in a zonefile, as generated by ZoneFile, as a string
+    with a fully qualified owner name, e.g.
+    "host.example.org. 300 IN A 10.0.0.1".
+
+    Only the subset of the zonefile syntax used by ZoneFile is supported.
+    """
+    origin = ""
+    owner = None
+    lines = iter(lines)
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith(";"):
+            continue
+        if line.startswith("$ORIGIN"):
+            origin = line.split()[1]
+            continue
+        if line.startswith("$"):
+            continue
+        if line.endswith("("):
+            # The SOA record spans several lines, with comments.
+            parts = [line]
+            while ")" not in line:
+                line = next(lines).split(";")[0]
+                parts.append(line)
+            line = " ".join(parts).replace("(", " ").replace(")", " ")
+        if not line[0].isspace():
+            owner, line = line.split(None, 1)
+            if owner == "@":
+                owner = origin
+            elif not owner.endswith("."):
+                owner = f"{owner}.{origin}"
+        tokens = line.split(None, 1)
+        ttl = ""
+        if tokens[0].isdigit():
+            ttl = tokens[0]
+            tokens = tokens[1].split(None, 1)
+        if tokens[0] == "IN":
+            tokens = tokens[1].split(None, 1)
+        record_type = tokens[0]
+        rdata = _split_rdata(tokens[1]) if len(tokens) > 1 else []
+        if record_type in NAME_RDATA_TYPES and rdata and not rdata[-1].endswith("."):
+            rdata[-1] = f"{rdata[-1]}.{origin}"
+        rdata = " ".join(rdata)
+        yield " ".join(i for i in (owner, ttl, "IN", record_type, rdata) if i)
+
+
+def diff_zonefiles(old, new):
+    """Return the records removed and added between two zonefiles, as
+    sorted lists. Duplicate records are counted."""
+    old = Counter(parse_zonefile(old))
+    new = Counter(parse_zonefile(new))
+    removed = sorted((old - new).elements())
+    added = sorted((new - old).elements())
+    return removed, added
+
 
 class Common:
 
     def __init__(self, zone):
         self.zone = zone
         self.glue_done = set()
+        self.glue = None
+
+    def ip_zf_string(self, name, ttl, ip):
+        if ip.version == 4:
+            iptype = "A"
+        else:
+            iptype = "AAAA"
+
+        data = {
+            'name': name,
+            'ttl': ttl,
+            'record_type': iptype,
+            'record_data': str(ip),
+        }
+        return '{name:24} {ttl:5} IN {record_type:6} {record_data:39}\n'.format_map(data)
+
+    def cache_glue(self):
+        """Fetch all in-zone name server hosts and their addresses in one
+        query. Hosts without any address get an empty list."""
+        self.glue = dict()
+        nameservers = NameServer.objects.filter(name__endswith="." + self.zone.name)
+        hosts = Host.objects.filter(name__in=nameservers.values('name'))
+        hosts = hosts.order_by('name', 'ipaddresses__ipaddress')
+        for name, zone_id, ttl, ip in hosts.values_list('name', 'zone_id', 'ttl',
+                                                        'ipaddresses__ipaddress'):
+            if name not in self.glue:
+                self.glue[name] = (zone_id, clear_none(ttl), [])
+            if ip is not None:
+                self.glue[name][2].append(ipaddress.ip_address(ip))
 
     def get_glue(self, ns):
         """Returns glue for a nameserver. If already used return blank"""
@@ -32,60 +366,50 @@ class Common:
             self.glue_done.add(ns)
         if not ns.endswith("." + self.zone.name):
             return ""
-        try:
-            host = Host.objects.get(name=ns)
-        except Host.DoesNotExist:
+        if self.glue is None:
+            self.cache_glue()
+        if ns not in self.glue:
             #XXX: signal hostmaster?
             return f"OPS: missing glue for {ns}\n"
-        if not host.ipaddresses.exists():
+        zone_id, ttl, ips = self.glue[ns]
+        if not ips:
             #XXX: signal hostmaster?
             return f"OPS: no ipaddress for name server {ns}\n"
         # self's name servers do not need glue, as they will come later
         # in the zonefile.
-        if host.zone == self.zone:
+        if zone_id == self.zone.id:
             return ""
-        data = ""
-        for ip in host.ipaddresses.all():
-            data += ip.zf_string(self.zone.name)
-        return data
+        name = idna_encode(qualify(ns, self.zone.name))
+        return "".join(self.ip_zf_string(name, ttl, ip) for ip in ips)
 
     def get_ns_data(self, qs):
-        data = ""
         qs = qs.prefetch_related("nameservers")
         for sub in qs:
             nameservers = sub.nameservers.all()
-            if not nameservers.exists():
+            if not nameservers:
                 # XXX What to do?
-                return f"OPS: NO NS FOR {sub.name}\n"
+                yield f"OPS: NO NS FOR {sub.name}\n"
+                return
             for ns in nameservers:
-                data += ns.zf_string(self.zone.name, subzone=sub.name)
-                data += self.get_glue(ns.name)
-        return data
+                yield ns.zf_string(self.zone.name, subzone=sub.name)
+                yield self.get_glue(ns.name)
 
     def get_delegations(self):
-        data = ""
         delegations = self.zone.delegations.all().order_by("name")
         if delegations:
-            data += self.get_ns_data(delegations)
-            data = ';\n; Delegations\n;\n' + data
-        return data
-
+            yield ';\n; Delegations\n;\n'
+            yield from self.get_ns_data(delegations)
 
-class ForwardFile(Common):
+    def get_header(self):
+        """Yield the SOA and the zone's own name servers."""
+        zone = self.zone
+        yield zone.zf_string
+        yield ';\n; Name servers\n;\n'
+        for ns in zone.nameservers.all():
+            yield ns.zf_string(zone.name)
 
-    def ip_zf_string(self, name, ttl, ip):
-        if ip.version == 4:
-            iptype = "A"
-        else:
-            iptype = "AAAA"
 
-        data = {
-            'name': name,
-            'ttl': ttl,
-            'record_type': iptype,
-            'record_data': str(ip),
-        }
-        return '{name:24} {ttl:5} IN {record_type:6} {record_data:39}\n'.format_map(data)
+class ForwardFile(Common):
 
     def mx_zf_string(self, name, ttl, priority, mx):
 
@@ -151,19 +475,28 @@ class ForwardFile(Common):
         }
         return '{alias:24} {ttl:5} IN {record_type:6} {record_data:39}\n'.format_map(data)
 
-    def host_data(self, host):
+    def loc_zf_string(self, name, loc):
+        """String representation for zonefile export."""
+        data = {
+            'name': name,
+            'record_type': 'LOC',
+            'record_data': loc
+        }
+        return '{name:30} IN {record_type:6} {record_data}\n'.format_map(data)
+
+    def host_data(self, hostname, ttl, hinfo, loc):
         data = ""
         first = True
-        name_idna = idna_encode(qualify(host.name, self.zone.name))
-        ttl = clear_none(host.ttl)
+        name_idna = idna_encode(qualify(hostname, self.zone.name))
+        ttl = clear_none(ttl)
         for values, func in ((self.ipaddresses, self.ip_zf_string),
                              (self.mxs, self.mx_zf_string),
                              (self.txts, self.txt_zf_string),
                              (self.sshfps, self.sshfp_zf_string),
                              (self.naptrs, self.naptr_zf_string),
                              ):
-            if host.name in values:
-                for i in values[host.name]:
+            if hostname in values:
+                for i in values[hostname]:
                     if first:
                         first = False
                         name = name_idna
@@ -172,14 +505,13 @@ class ForwardFile(Common):
                     data += func(name, ttl, *i)
 
 
-        # XXX: add caching for this one, if we populate it..
-        if host.hinfo is not None:
-            data += host.hinfo.zf_string
-        if host.loc:
-            data += host.loc_string(self.zone.name)
+        if hinfo is not None:
+            data += self.hinfos[hinfo]
+        if loc:
+            data += self.loc_zf_string(name_idna, loc)
         # For entries where the host is the resource record
-        if host.name in self.host_cnames:
-            for alias, ttl in self.host_cnames[host.name]:
+        if hostname in self.host_cnames:
+            for alias, ttl in self.host_cnames[hostname]:
                 data += self.cname_zf_string(alias, ttl, name_idna)
         return data
 
@@ -191,6 +523,9 @@ class ForwardFile(Common):
         self.sshfps = defaultdict(list)
         self.txts = defaultdict(list)
 
+        # The presets are few, so render all of them once.
+        self.hinfos = {hinfo.id: hinfo.zf_string for hinfo in HinfoPreset.objects.all()}
+
         cnames = Cname.objects.filter(zone=self.zone).filter(host__zone=self.zone)
         for hostname, alias, ttl, in cnames.values_list('host__name', 'name', 'ttl'):
             self.host_cnames[hostname].append((alias, ttl))
@@ -217,90 +552,74 @@ class ForwardFile(Common):
             self.txts[hostname].append((txt,))
 
     def get_subdomains(self):
-        data = ""
         subzones = ForwardZone.objects.filter(name__endswith="." + self.zone.name)
         if subzones:
-            data += self.get_ns_data(subzones.order_by("name"))
-            data = ';\n; Subdomains\n;\n' + data
-        return data
+            yield ';\n; Subdomains\n;\n'
+            yield from self.get_ns_data(subzones.order_by("name"))
 
     def generate(self):
         zone = self.zone
         self.cache_hostdata()
         # Print info about Zone and its nameservers
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-
-        data += self.get_delegations()
-        data += self.get_subdomains()
-        try:
-            root = Host.objects.get(name=zone.name)
-            root_data = self.host_data(root)
+        yield from self.get_header()
+        yield from self.get_delegations()
+        yield from self.get_subdomains()
+        fields = ('name', 'ttl', 'hinfo', 'loc')
+        root = Host.objects.filter(name=zone.name).values_list(*fields).first()
+        if root is not None:
+            root_data = self.host_data(*root)
             if root_data:
-                data += ";\n"
-                data += "@" + root_data
-                data += ";\n"
-        except Host.DoesNotExist:
-            pass
+                yield ";\n"
+                yield "@" + root_data
+                yield ";\n"
         # Print info about hosts and their corresponding data
         hosts = Host.objects.filter(zone=zone.id).order_by('name')
         hosts = hosts.exclude(name=zone.name)
-        if hosts:
-            data += ';\n; Host addresses\n;\n'
-            for host in hosts:
-                data += self.host_data(host)
+        if hosts.exists():
+            yield ';\n; Host addresses\n;\n'
+            for host in hosts.values_list(*fields).iterator():
+                yield self.host_data(*host)
         # Print misc entries
         srvs = Srv.objects.filter(zone=zone.id)
         if srvs:
-            data += ';\n; Services\n;\n'
+            yield ';\n; Services\n;\n'
             for srv in srvs:
-                data += srv.zf_string(zone.name)
+                yield srv.zf_string(zone.name)
         cnames = Cname.objects.filter(zone=zone.id).exclude(host__zone=zone.id)
         if cnames:
-            data += ';\n; Cnames pointing out of the zone\n;\n'
+            yield ';\n; Cnames pointing out of the zone\n;\n'
             for cname in cnames:
-                data += cname.zf_string(zone.name)
-        return data
+                yield cname.zf_string(zone.name)
 
 
 class IPv4ReverseFile(Common):
 
     def generate(self):
         zone = self.zone
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-        data += self.get_delegations()
+        yield from self.get_header()
+        yield from self.get_delegations()
         _prev_net = 'z'
         for ip, ttl, hostname in zone.get_ipaddresses():
             rev = ip.reverse_pointer
             # Add $ORIGIN between every new /24 found
             if not rev.endswith(_prev_net):
                 _prev_net = rev[rev.find('.'):]
-                data += "$ORIGIN {}.\n".format(_prev_net[1::])
+                yield "$ORIGIN {}.\n".format(_prev_net[1::])
             ptrip = rev[:rev.find('.')]
-            data += "{} {}\tPTR\t{}.\n".format(ptrip, ttl, idna_encode(hostname))
-        return data
+            yield "{} {}\tPTR\t{}.\n".format(ptrip, ttl, idna_encode(hostname))
 
 
 class IPv6ReverseFile(Common):
 
     def generate(self):
         zone = self.zone
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-        data += self.get_delegations()
+        yield from self.get_header()
+        yield from self.get_delegations()
         _prev_net = 'z'
         for ip, ttl, hostname in zone.get_ipaddresses():
             rev = ip.reverse_pointer
             # Add $ORIGIN between every new /64 found
             if not rev.endswith(_prev_net):
                 _prev_net = rev[32:]
-                data += "$ORIGIN {}.\n".format(_prev_net)
-            data += "{} {}\tPTR\t{}.\n".format(rev[:31], ttl, idna_encode(hostname))
-        return data
+                yield "$ORIGIN {}.\n".format(_prev_net)
+            yield "{} {}\tPTR\t{}.\n".format(rev[:31], ttl, idna_encode(hostname))
@@ -0,0 +1,30 @@
+from django.db import models
+
+
+class CidrAddressField(models.TextField):
+    """
+    A network, e.g. '10.0.0.0/24', stored in the PostgreSQL cidr type.
+
+    Values are strings, as for a TextField, but the database can index the
+    column with GiST and answer containment and overlap lookups with the
+    inet operators, without casting every row.
+    """
+
+    description = "Network address in CIDR notation"
+
+    def db_type(self, connection):
+        return 'cidr'
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        # An empty string is not a valid cidr, so a blank network is stored
+        # as NULL, and can only be saved if the field is nullable.
+        if value == '':
+            return None
+        return value
+
+    def from_db_value(self, value, expression, connection):
+        # Read a blank network back as an empty string, as for a TextField.
+        if value is None and self.blank:
+            return ''
+        return value
@@ -0,0 +1,97 @@
+"""
+History entries are saved as chains, each starting with a full snapshot of
+the object, a keyframe, followed by deltas against the previous entry. A new
+keyframe is started after HOST_HISTORY_KEYFRAME_INTERVAL entries, so that at
+most that many entries are read to restore one.
+
+A delta is {"set": {key: value, ...}, "unset": [key, ...]}, with the keys
+whose values were changed or added, and removed. Values are not diffed
+further, so a changed list of records is saved in full.
+"""
+
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import OuterRef, Subquery
+
+from mreg.models import ModelChangeLog
+
+
+def diff(old, new):
+    """Return the delta from the dict old to the dict new."""
+    delta = {}
+    changed = {key: value for key, value in new.items()
+               if key not in old or old[key] != value}
+    if changed:
+        delta['set'] = changed
+    removed = [key for key in old if key not in new]
+    if removed:
+        delta['unset'] = removed
+    return delta
+
+
+def patch(old, delta):
+    """Return a new dict with delta applied to the dict old."""
+    new = dict(old)
+    new.update(delta.get('set', {}))
+    for key in delta.get('unset', ()):
+        new.pop(key, None)
+    return new
+
+
+def restore(entries):
+    """Return the entries, dicts with the fields of a ModelChangeLog, in the
+    same order with the data of the deltas replaced by the full data. The
+    entries must be ordered by id, and start with a keyframe for each row."""
+    latest = {}
+    restored = []
+    for entry in entries:
+        entry = dict(entry)
+        key = (entry['table_name'], entry['table_row'])
+        if entry.pop('is_delta'):
+            entry['data'] = patch(latest[key], entry['data'])
+        latest[key] = entry['data']
+        restored.append(entry)
+    return restored
+
+
+def _to_json(data):
+    # The data as it is read back from the database, to compare it with
+    # the saved data.
+    return json.loads(json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def get_latest(table_name, rows):
+    """Return a dict of each row in rows with history, to its latest data and
+    the number of entries in its chain."""
+    keyframes = ModelChangeLog.objects.filter(
+        table_name=table_name, table_row=OuterRef('table_row'), is_delta=False)
+    keyframe = keyframes.order_by('-id').values('id')[:1]
+    entries = ModelChangeLog.objects.filter(
+        table_name=table_name, table_row__in=rows, id__gte=Subquery(keyframe))
+    latest = {}
+    for row, is_delta, data in entries.order_by('id').values_list(
+            'table_row', 'is_delta', 'data'):
+        if is_delta:
+            previous, length = latest[row]
+            latest[row] = (patch(previous, data), length + 1)
+        else:
+            latest[row] = (data, 1)
+    return latest
+
+
+def make_entry(latest, table_name, table_row, data, **kwargs):
+    """Return a ModelChangeLog for the data of the row, as a delta against
+    the entry in latest, from get_latest(), or as a keyframe."""
+    data = _to_json(data)
+    interval = getattr(settings, 'HOST_HISTORY_KEYFRAME_INTERVAL', 10)
+    previous, length = latest.get(table_row, (None, 0))
+    # Legacy entries which were not valid JSON are kept as strings, and can
+    # not be diffed against, so start a new chain after them.
+    is_delta = isinstance(previous, dict) and length < interval
+    latest[table_row] = (data, length + 1 if is_delta else 1)
+    if is_delta:
+        data = diff(previous, data)
+    return ModelChangeLog(table_name=table_name, table_row=table_row,
+                          data=data, is_delta=is_delta, **kwargs)
@@ -0,0 +1,123 @@
+import io
+import multiprocessing
+import os
+import re
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import quote
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from mreg.api.v1.zonefile import CHUNK_SIZE, ZoneFile, ZoneFileCache, write_atomic
+from mreg.models import ForwardZone, ReverseZone
+
+
+SERIAL_RE = re.compile(r'^\s*(\d+)\s*; Serialnumber$')
+
+
+def get_file_serialno(path):
+    """Return the serial number of an exported zonefile, or None."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            # The serial number is on the fourth line of the SOA record, but
+            # allow for a few more lines in case the header changes.
+            for _, line in zip(range(10), f):
+                m = SERIAL_RE.match(line)
+                if m:
+                    return int(m.group(1))
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def export_zone(model_label, pk, path):
+    """Write the zonefile for a zone to path.
+
+    Run in the worker processes, so only takes picklable arguments.
+    Returns the zone name and the number of seconds used.
+    """
+    start = time.monotonic()
+    zone = apps.get_model(model_label).objects.get(pk=pk)
+    cache = ZoneFileCache()
+    cached = cache.get(zone)
+    if cached is not None:
+        with io.TextIOWrapper(cached, encoding='utf-8') as f:
+            chunks = iter(lambda: f.read(CHUNK_SIZE), '')
+            for _ in write_atomic(path, chunks):
+                pass
+    else:
+        chunks = cache.stream(zone, ZoneFile(zone).stream())
+        for _ in write_atomic(path, chunks):
+            pass
+    return zone.name, time.monotonic() - start
+
+
+class Command(BaseCommand):
+    help = 'Export zonefiles for updated zones, or all zones, to a directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory',
+                            help='Directory to write the zonefiles to.')
+        parser.add_argument('--all', action='store_true',
+                            help='Export all zones, not only the updated ones.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes. Default is the '
+                                 'number of CPUs.')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        os.makedirs(directory, exist_ok=True)
+
+        jobs = []
+        for model in (ForwardZone, ReverseZone):
+            zones = model.objects.all()
+            if not options['all']:
+                zones = zones.filter(updated=True)
+            for zone in zones:
+                zone.update_serialno()
+                path = os.path.join(directory, quote(zone.name, safe=''))
+                if get_file_serialno(path) == zone.serialno:
+                    self.stdout.write(f'{zone.name}: unchanged serial {zone.serialno}')
+                    continue
+                jobs.append((zone.name, (model._meta.label, zone.pk, path)))
+
+        start = time.monotonic()
+        failed = []
+        for name, elapsed, error in self._run(jobs, options['workers']):
+            if error is not None:
+                failed.append(name)
+                self.stderr.write(f'{name}: failed: {error}')
+            else:
+                self.stdout.write(f'{name}: exported in {elapsed:.3f}s')
+        self.stdout.write(f'Exported {len(jobs) - len(failed)} of {len(jobs)} zones '
+                          f'in {time.monotonic() - start:.3f}s')
+        if failed:
+            raise CommandError(f'Failed to export: {", ".join(failed)}')
+
+    def _run(self, jobs, workers):
+        """Export the zones, yielding (name, seconds, error) as they finish."""
+        if workers == 1 or len(jobs) <= 1:
+            for name, job in jobs:
+                try:
+                    yield export_zone(*job) + (None,)
+                except Exception as e:
+                    yield name, None, e
+            return
+        # The forked workers must not share the database connections of
+        # this process, so close them and let each worker open its own.
+        connections.close_all()
+        # Fork, so the workers inherit the set up Django, also where the
+        # default is to spawn them.
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = {executor.submit(export_zone, *job): name for name, job in jobs}
+            for future in as_completed(futures):
+                try:
+                    yield future.result() + (None,)
+                except Exception as e:
+                    yield futures[future], None, e
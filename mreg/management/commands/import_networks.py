@@ -0,0 +1,34 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from mreg.api.v1.network_import import NetworkOverlapError, import_networks, read_csv
+
+
+class Command(BaseCommand):
+    help = ('Create networks from a CSV file with a header line of field names, '
+            'or a JSON file with a list of networks. None are created if any '
+            'are invalid or overlap.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='File to read the networks from.')
+        parser.add_argument('--format', choices=('csv', 'json'),
+                            help='Format of the file. Default is csv if the '
+                                 'file name ends with .csv, else json.')
+
+    def handle(self, *args, **options):
+        path = options['file']
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'json')
+        try:
+            with open(path, encoding='utf-8', newline='') as f:
+                rows = read_csv(f) if fmt == 'csv' else json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not read {path}: {e}')
+        try:
+            networks = import_networks(rows)
+        except ValidationError as e:
+            raise CommandError(f'Invalid networks: {e.detail}')
+        except NetworkOverlapError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f'Created {len(networks)} networks')
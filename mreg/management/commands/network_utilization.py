@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from mreg.models import Network
+
+
+class Command(BaseCommand):
+    help = 'Show the number of used and unused addresses for all networks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--category', help='Only networks in this category.')
+        parser.add_argument('--location', help='Only networks in this location.')
+        parser.add_argument('--vlan', type=int, help='Only networks on this vlan.')
+
+    def handle(self, *args, **options):
+        networks = Network.objects.all()
+        for field in ('category', 'location', 'vlan'):
+            if options[field] is not None:
+                networks = networks.filter(**{field: options[field]})
+        self.stdout.write(f"{'network':43} {'size':>10} {'reserved':>8} "
+                          f"{'used':>8} {'unused':>10} {'used%':>6}")
+        for i in Network.get_utilization(networks):
+            available = i['size'] - i['reserved']
+            usage = 100 * (available - i['unused']) / available if available else 100
+            self.stdout.write(f"{i['network']:43} {i['size']:10} {i['reserved']:8} "
+                              f"{i['used']:8} {i['unused']:10} {usage:6.1f}")
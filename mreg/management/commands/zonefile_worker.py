@@ -0,0 +1,86 @@
+import os
+import time
+
+from datetime import timedelta
+from urllib.parse import quote
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from mreg.api.v1.zonefile import ZoneFile, ZoneFileCache
+from mreg.models import ForwardZone, ReverseZone
+
+from .export_zonefiles import export_zone
+
+
+class Command(BaseCommand):
+    help = ('Watch for updated zones, update their serial numbers and '
+            'generate their zonefiles.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory',
+                            help='Also write the zonefiles to this directory.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between each check for updated zones. '
+                                 'Default is 5.')
+        parser.add_argument('--debounce', type=float, default=30,
+                            help='Seconds a zone must have been unchanged before '
+                                 'it is exported. Default is 30.')
+        parser.add_argument('--max-delay', type=float, default=300,
+                            help='Export a zone which keeps changing when its serial '
+                                 'number is this many seconds old. Default is 300.')
+        parser.add_argument('--once', action='store_true',
+                            help='Check for updated zones once and exit.')
+
+    def handle(self, *args, **options):
+        if not options['directory'] and not ZoneFileCache().directory:
+            # Else the zones would be marked as exported without any output.
+            raise CommandError('Either --directory or ZONEFILE_CACHE_DIR must be set')
+        if options['directory']:
+            os.makedirs(options['directory'], exist_ok=True)
+        while True:
+            try:
+                self.export_updated_zones(options)
+            except DatabaseError as e:
+                if options['once']:
+                    raise
+                self.stderr.write(f'Could not check for updated zones: {e}')
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+            # Like at the end of a request. Drops the connection if it is
+            # broken, e.g. after a database restart, so the next check opens
+            # a new one.
+            close_old_connections()
+
+    def export_updated_zones(self, options):
+        now = timezone.now()
+        # Wait until a burst of changes to a zone is over, but not forever.
+        ready = Q(updated_at__lte=now - timedelta(seconds=options['debounce'])) | \
+            Q(serialno_updated_at__lte=now - timedelta(seconds=options['max_delay']))
+        for model in (ForwardZone, ReverseZone):
+            for zone in model.objects.filter(ready, updated=True):
+                try:
+                    self.export(zone, options['directory'])
+                except Exception as e:
+                    self.stderr.write(f'{zone.name}: failed: {e}')
+
+    def export(self, zone, directory):
+        start = time.monotonic()
+        zone.update_serialno()
+        if zone.updated:
+            # The serial number was updated too recently, try again later.
+            return
+        cache = ZoneFileCache()
+        if directory:
+            path = os.path.join(directory, quote(zone.name, safe=''))
+            export_zone(zone._meta.label, zone.pk, path)
+        elif cache.directory:
+            # Generate into the cache, so requests for the zonefile are
+            # served from it.
+            for _ in cache.stream(zone, ZoneFile(zone).stream()):
+                pass
+        self.stdout.write(f'{zone.name}: serial {zone.serialno} exported in '
+                          f'{time.monotonic() - start:.3f}s')
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2026-10-16 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ipaddress',
+            name='ipaddress',
+            field=models.GenericIPAddressField(db_index=True),
+        ),
+    ]
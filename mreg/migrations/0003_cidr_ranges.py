@@ -0,0 +1,54 @@
+# Generated by Django 2.1.7 on 2026-10-16 13:41
+
+from django.db import migrations, models
+import mreg.fields
+import mreg.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0002_ipaddress_index'),
+    ]
+
+    operations = [
+        # A blank range is not a valid cidr, so store it as NULL.
+        migrations.AlterField(
+            model_name='netgroupregexpermission',
+            name='range',
+            field=models.TextField(blank=True, null=True, validators=[mreg.validators.validate_network]),
+        ),
+        migrations.RunSQL(
+            sql="UPDATE perm_net_group_regex SET range = NULL WHERE range = ''",
+            reverse_sql="UPDATE perm_net_group_regex SET range = '' WHERE range IS NULL",
+        ),
+        migrations.AlterField(
+            model_name='netgroupregexpermission',
+            name='range',
+            field=mreg.fields.CidrAddressField(blank=True, null=True, validators=[mreg.validators.validate_network]),
+        ),
+        migrations.AlterField(
+            model_name='network',
+            name='range',
+            field=mreg.fields.CidrAddressField(unique=True, validators=[mreg.validators.validate_network]),
+        ),
+        migrations.AlterField(
+            model_name='reversezone',
+            name='range',
+            field=mreg.fields.CidrAddressField(blank=True, unique=True, validators=[mreg.validators.validate_network]),
+        ),
+        # Index the ranges for the inet containment and overlap operators.
+        migrations.RunSQL(
+            sql=[
+                "CREATE INDEX perm_net_group_regex_range_gist ON perm_net_group_regex "
+                "USING gist (range inet_ops)",
+                "CREATE INDEX network_range_gist ON network USING gist (range inet_ops)",
+                "CREATE INDEX reverse_zone_range_gist ON reverse_zone USING gist (range inet_ops)",
+            ],
+            reverse_sql=[
+                "DROP INDEX perm_net_group_regex_range_gist",
+                "DROP INDEX network_range_gist",
+                "DROP INDEX reverse_zone_range_gist",
+            ],
+        ),
+    ]
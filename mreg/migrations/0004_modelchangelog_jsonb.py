@@ -0,0 +1,80 @@
+# Generated by Django 2.1.7 on 2026-10-16 16:02
+
+import ast
+import json
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+# The history was saved as the repr() of the serialized host, where the
+# nested records are OrderedDicts.
+DICT_CLASSES = ('dict', 'OrderedDict', 'ReturnDict')
+
+
+def _literal(node):
+    """Like ast.literal_eval(), but also allows the dict classes above."""
+    if isinstance(node, ast.Expression):
+        return _literal(node.body)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+            and node.func.id in DICT_CLASSES and not node.keywords:
+        if not node.args:
+            return {}
+        return dict(_literal(node.args[0]))
+    if isinstance(node, ast.Dict):
+        return {_literal(k): _literal(v) for k, v in zip(node.keys, node.values)}
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [_literal(i) for i in node.elts]
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -_literal(node.operand)
+    return ast.literal_eval(node)
+
+
+def parse_data(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return _literal(ast.parse(text, mode='eval'))
+    except (SyntaxError, ValueError, TypeError):
+        # Keep what can not be parsed as a JSON string.
+        return text
+
+
+def repr_to_json(apps, schema_editor):
+    ModelChangeLog = apps.get_model('mreg', 'ModelChangeLog')
+    rows = ModelChangeLog.objects.values_list('id', 'data').iterator()
+    with schema_editor.connection.cursor() as cursor:
+        batch = []
+        for pk, text in rows:
+            data = json.dumps(parse_data(text),
+                              cls=django.core.serializers.json.DjangoJSONEncoder)
+            batch.append((data, pk))
+            if len(batch) == 1000:
+                cursor.executemany('UPDATE model_change_log SET data = %s WHERE id = %s', batch)
+                batch = []
+        if batch:
+            cursor.executemany('UPDATE model_change_log SET data = %s WHERE id = %s', batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0003_cidr_ranges'),
+    ]
+
+    operations = [
+        # Rewrite the text as JSON, so it can be cast to jsonb.
+        migrations.RunPython(repr_to_json, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='modelchangelog',
+            name='data',
+            field=django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder),
+        ),
+        migrations.AddIndex(
+            model_name='modelchangelog',
+            index=models.Index(fields=['table_name', 'table_row', 'timestamp'], name='model_change_log_lookup_idx'),
+        ),
+    ]
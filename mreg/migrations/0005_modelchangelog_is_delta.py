@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2026-10-16 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0004_modelchangelog_jsonb'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelchangelog',
+            name='is_delta',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 2.1.7 on 2026-10-17 09:30
+
+from django.db import migrations
+
+
+TABLES = ('network', 'reverse_zone')
+
+
+def _create_triggers(table):
+    return [
+        f"CREATE TRIGGER {table}_prefix_index_generation "
+        f"AFTER INSERT OR DELETE OR TRUNCATE ON {table} "
+        f"FOR EACH STATEMENT EXECUTE PROCEDURE bump_prefix_index_generation()",
+        f"CREATE TRIGGER {table}_row_prefix_index_generation "
+        f"AFTER UPDATE ON {table} FOR EACH ROW "
+        f"WHEN (OLD.range IS DISTINCT FROM NEW.range) "
+        f"EXECUTE PROCEDURE bump_prefix_index_generation()",
+    ]
+
+
+def _drop_triggers(table):
+    return [
+        f"DROP TRIGGER {table}_prefix_index_generation ON {table}",
+        f"DROP TRIGGER {table}_row_prefix_index_generation ON {table}",
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0005_modelchangelog_is_delta'),
+    ]
+
+    operations = [
+        # A counter per table which is bumped when rows are inserted or
+        # deleted, or their range is changed, also by queryset updates and
+        # other processes, so the in-memory prefix indexes can see when they
+        # must be rebuilt. Other changes, like the serial number and updated
+        # flag of the zones, leave the indexes alone. The counter is taken
+        # from a sequence, which is not rolled back, so that an index built
+        # in a rolled back transaction never matches a later generation.
+        migrations.RunSQL(
+            sql=[
+                "CREATE SEQUENCE prefix_index_generation_seq",
+                "CREATE TABLE prefix_index_generation ("
+                "table_name text PRIMARY KEY, generation bigint NOT NULL)",
+                """
+                CREATE FUNCTION bump_prefix_index_generation() RETURNS trigger
+                LANGUAGE plpgsql AS $$
+                BEGIN
+                    INSERT INTO prefix_index_generation (table_name, generation)
+                    VALUES (TG_TABLE_NAME, nextval('prefix_index_generation_seq'))
+                    ON CONFLICT (table_name) DO UPDATE
+                    SET generation = EXCLUDED.generation;
+                    RETURN NULL;
+                END
+                $$
+                """,
+            ] + [sql for table in TABLES for sql in _create_triggers(table)],
+            reverse_sql=[sql for table in TABLES for sql in _drop_triggers(table)] + [
+                "DROP FUNCTION bump_prefix_index_generation()",
+                "DROP TABLE prefix_index_generation",
+                "DROP SEQUENCE prefix_index_generation_seq",
+            ],
+        ),
+    ]
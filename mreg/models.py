@@ -1,9 +1,13 @@
+import heapq
 import ipaddress
 
-from collections import defaultdict
 from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
 
-from django.db import DatabaseError, models, transaction
+from django.contrib.postgres.fields import JSONField
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection, models, transaction
 from django.utils import timezone
 
 from mreg.validators import (validate_hostname, validate_reverse_zone_name,
@@ -13,9 +17,13 @@ from mreg.validators import (validate_hostname, validate_reverse_zone_name,
                              validate_network, validate_ttl, validate_hexadecimal,
                              validate_regex)
 from mreg.utils import (create_serialno, encode_mail, clear_none, qualify,
-        idna_encode, get_network_from_zonename)
+        idna_encode, get_network_from_zonename, ip_to_int, collapse_ranges,
+        merge_ranges)
 
+from .fields import CidrAddressField
 from .models_auth import User
+from .prefixes import PrefixIndex
+from .usage import UsageBitmapCache
 
 
 class NameServer(models.Model):
@@ -79,6 +87,51 @@ class ZoneHelpers:
         self.update_nameservers([])
 
 
+class TrackedFieldsMixin:
+    """
+    Keeps the values of the tracked_fields as loaded from, or last saved to,
+    the database, so signal handlers can compare the old and new values
+    without fetching the object again. The values are updated after the
+    post_save signal is sent.
+    """
+
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._save_original()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._save_original(fields)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._save_original(kwargs.get('update_fields'))
+
+    def _save_original(self, fields=None):
+        original = getattr(self, '_original', {})
+        for field in self.tracked_fields:
+            # Skip deferred fields, which are not in __dict__.
+            if field in self.__dict__ and (fields is None or field in fields or
+                                           field.endswith('_id') and field[:-3] in fields):
+                original[field] = self.__dict__[field]
+        self._original = original
+
+    def get_original(self, field):
+        """Returns the value of a tracked field in the database, or None if the
+        object is not saved."""
+        if self.pk is None:
+            return None
+        original = getattr(self, '_original', {})
+        if field in original:
+            return original[field]
+        # Not loaded from the database, or the field was deferred.
+        return type(self).objects.filter(pk=self.pk).values_list(field, flat=True).first()
+
+
 class BaseZone(models.Model, ZoneHelpers):
     updated_at = models.DateTimeField(auto_now=True)
     updated = models.BooleanField(default=True)
@@ -179,15 +232,29 @@ class ForwardZone(BaseZone):
         return None
 
 
-class ReverseZone(BaseZone):
+class ReverseZone(TrackedFieldsMixin, BaseZone):
     name = models.CharField(unique=True, max_length=253, validators=[validate_reverse_zone_name])
     # range can not be blank, but it will allow full_clean() to pass, even if
     # the range is not set. Will anyway be overridden by update() and save().
-    range = models.TextField(unique=True, blank=True, validators=[validate_network])
+    range = CidrAddressField(unique=True, blank=True, validators=[validate_network])
+
+    tracked_fields = ('range', )
+    prefix_index = PrefixIndex('mreg.ReverseZone')
 
     class Meta:
         db_table = 'reverse_zone'
 
+    def clean(self):
+        # Set the range before the unique checks, as a blank range can not be
+        # compared with the cidr column.
+        try:
+            network = get_network_from_zonename(self.name)
+        except ValueError:
+            # An invalid name, which is reported by its validator.
+            return
+        if network is not None:
+            self.range = network
+
     def update(self, *args, **kwargs):
         self.range = get_network_from_zonename(self.name)
         super().update(*args, **kwargs)
@@ -202,55 +269,46 @@ class ReverseZone(BaseZone):
 
     @staticmethod
     def get_zone_by_ip(ip):
-        """Search and return a zone which contains an IP address."""
-        where = [ "inet %s <<= range::inet" ]
-        return ReverseZone.objects.extra(where=where, params=[str(ip)]).first()
+        """Search and return the most specific zone which contains an IP
+        address."""
+        return ReverseZone.prefix_index.get(ip)
 
     def get_ipaddresses(self):
+        """
+        Yield (ip, ttl, hostname) for each PTR record in the zone, ordered by
+        ip. The rows are streamed from the database already ordered, so the
+        zone is never loaded into memory at once.
+        """
         network = self.network
         from_ip = str(network.network_address)
         to_ip = str(network.broadcast_address)
+        fields = ('ipaddress', 'host__ttl', 'host__name')
         ips = Ipaddress.objects.filter(ipaddress__range=(from_ip, to_ip))
-        ips = ips.select_related('host')
-        override_ips = dict()
+        ips = ips.order_by('ipaddress').values_list(*fields)
         ptrs = PtrOverride.objects.filter(ipaddress__range=(from_ip, to_ip))
-        ptrs = ptrs.select_related('host')
-        for p in ptrs:
-            override_ips[p.ipaddress] = p
-        # XXX: send signal/mail to hostmaster(?) about issues with multiple_ip_no_ptr
-        count = defaultdict(int)
-        for i in ips:
-            if i.ipaddress not in override_ips:
-                count[i.ipaddress] += 1
-        multiple_ip_no_ptr = {i: count[i] for i in count if count[i] > 1}
-        ptr_done = set()
-        # Use PtrOverrides when found, but only once. Also skip IPaddresses
-        # which have been used multiple times, but lacks a PtrOverride.
-        result = []
-
-        def _add_to_result(item):
-            ttl = item.host.ttl or ""
-            result.append((ipaddress.ip_address(item.ipaddress), ttl, item.host.name))
-
-        for i in ips:
-            ip = i.ipaddress
-            if ip in multiple_ip_no_ptr:
-                continue
-            if ip in override_ips:
-                if ip not in ptr_done:
-                    ptr_done.add(ip)
-                    _add_to_result(override_ips[ip])
-            else:
-                _add_to_result(i)
-        # Add PtrOverrides which actually don't override anything,
-        # but are only used as PTRs without any Ipaddress object creating
-        # forward entries.
-        for k, v in override_ips.items():
-            if k not in ptr_done:
-                _add_to_result(v)
-
-        # Return sorted by IP
-        return sorted(result, key=lambda i: i[0])
+        ptrs = ptrs.order_by('ipaddress').values_list(*fields)
+        for ip, ttl, hostname in _merge_ptr_records(ips.iterator(), ptrs.iterator()):
+            yield ip, ttl or "", hostname
+
+
+def _merge_ptr_records(ips, ptrs):
+    """
+    Merge (ip, ttl, hostname) rows from Ipaddress and PtrOverride, both
+    ordered by ip, into the PTR records to use for each ip.
+
+    Use PtrOverrides when found, but only once. Also skip IPaddresses which
+    have been used multiple times, but lacks a PtrOverride. PtrOverrides
+    without any Ipaddress are used as is.
+    """
+    # XXX: send signal/mail to hostmaster(?) about issues with multiple_ip_no_ptr
+    # Tag the rows so a PtrOverride sorts before the Ipaddresses of its ip.
+    ptrs = ((ipaddress.ip_address(ip), 0, ttl, name) for ip, ttl, name in ptrs)
+    ips = ((ipaddress.ip_address(ip), 1, ttl, name) for ip, ttl, name in ips)
+    merged = heapq.merge(ptrs, ips, key=itemgetter(0, 1))
+    for ip, rows in groupby(merged, key=itemgetter(0)):
+        _, tag, ttl, name = next(rows)
+        if tag == 0 or next(rows, None) is None:
+            yield ip, ttl, name
 
 
 class ForwardZoneDelegation(models.Model, ZoneHelpers):
@@ -277,9 +335,11 @@ class ReverseZoneDelegation(models.Model, ZoneHelpers):
         return f"{self.zone.name} {self.name}"
 
 
-class ForwardZoneMember(models.Model):
+class ForwardZoneMember(TrackedFieldsMixin, models.Model):
     zone = models.ForeignKey(ForwardZone, models.DO_NOTHING, db_column='zone', blank=True, null=True)
 
+    tracked_fields = ('zone_id', )
+
     class Meta:
         abstract = True
 
@@ -313,6 +373,8 @@ class Host(ForwardZoneMember):
     loc = models.TextField(blank=True, validators=[validate_loc])
     comment = models.TextField(blank=True)
 
+    tracked_fields = ('zone_id', 'name')
+
     class Meta:
         db_table = 'host'
 
@@ -320,15 +382,6 @@ class Host(ForwardZoneMember):
     def __str__(self):
         return str(self.name)
 
-    def loc_string(self, zone):
-        """String representation for zonefile export."""
-        data = {
-            'name': idna_encode(qualify(self.name, zone)),
-            'record_type': 'LOC',
-            'record_data': self.loc
-        }
-        return '{name:30} IN {record_type:6} {record_data}\n'.format_map(data)
-
 
 class Sshfp(models.Model):
     host = models.ForeignKey(Host, on_delete=models.CASCADE, db_column='host')
@@ -347,11 +400,13 @@ class Sshfp(models.Model):
         )
 
 
-class Ipaddress(models.Model):
+class Ipaddress(TrackedFieldsMixin, models.Model):
     host = models.ForeignKey(Host, on_delete=models.CASCADE, db_column='host', related_name='ipaddresses')
-    ipaddress = models.GenericIPAddressField()
+    ipaddress = models.GenericIPAddressField(db_index=True)
     macaddress = models.CharField(max_length=17, blank=True, validators=[validate_mac_address])
 
+    tracked_fields = ('ipaddress', )
+
     class Meta:
         db_table = 'ipaddress'
         unique_together = (('host', 'ipaddress'), )
@@ -409,8 +464,8 @@ class Cname(ForwardZoneMember):
         return "{} -> {}".format(str(self.name), str(self.host))
 
 
-class Network(models.Model):
-    range = models.TextField(unique=True, validators=[validate_network])
+class Network(TrackedFieldsMixin, models.Model):
+    range = CidrAddressField(unique=True, validators=[validate_network])
     description = models.TextField(blank=True)
     vlan = models.IntegerField(blank=True, null=True)
     dns_delegated = models.BooleanField(default=False)
@@ -419,6 +474,10 @@ class Network(models.Model):
     frozen = models.BooleanField(default=False)
     reserved = models.PositiveIntegerField(default=3)
 
+    tracked_fields = ('range', )
+    prefix_index = PrefixIndex('mreg.Network')
+    usage_bitmaps = UsageBitmapCache()
+
     class Meta:
         db_table = 'network'
         ordering = ('range',)
@@ -430,15 +489,24 @@ class Network(models.Model):
     def network(self):
         return ipaddress.ip_network(self.range)
 
-    def get_reserved_ipaddresses(self):
-        """ Returns a set with the reserved ip addresses for the network."""
+    def get_reserved_ranges(self):
+        """
+        Returns the reserved addresses of the network as a sorted list of
+        (first, last) integer ranges: the network address, the first
+        "reserved" host addresses, and the broadcast address for IPv4.
+        """
         network = self.network
-        ret = set([network.network_address])
-        for i, ip in zip(range(self.reserved), network.hosts()):
-            ret.add(ip)
-        if isinstance(network, ipaddress.IPv4Network):
-            ret.add(network.broadcast_address)
-        return ret
+        first, last = self._get_host_range()
+        ranges = [(int(network.network_address), int(network.network_address))]
+        if self.reserved:
+            ranges.append((first, min(first + self.reserved - 1, last)))
+        if network.version == 4:
+            ranges.append((int(network.broadcast_address), int(network.broadcast_address)))
+        return merge_ranges(ranges)
+
+    def get_reserved_ipaddresses(self):
+        """Yields the reserved ip addresses for the network in order."""
+        return self._ip_addresses(self.get_reserved_ranges())
 
     def _get_used_ipaddresses(self):
         from_ip = str(self.network.network_address)
@@ -447,53 +515,212 @@ class Network(models.Model):
         #ips = Ipaddress.objects.extra(where=[where_str])
         return Ipaddress.objects.filter(ipaddress__range=(from_ip, to_ip))
 
+    def _get_usage_bitmap(self):
+        """
+        Returns the cached UsageBitmap of the network, or None if not cached.
+        """
+        return Network.usage_bitmaps.get(
+            self.network,
+            lambda: self._get_used_ipaddresses().values_list('ipaddress', flat=True))
+
+    def _get_used_values(self, first, last):
+        """
+        Yields the used addresses from first to last as integers, in order,
+        fetched in chunks as needed.
+        """
+        used = Ipaddress.objects.filter(ipaddress__range=(str(self._ip_address(first)),
+                                                          str(self._ip_address(last))))
+        used = used.order_by('ipaddress').values_list('ipaddress', flat=True).distinct()
+        for ip in used.iterator():
+            yield ip_to_int(ip)
+
+    def get_used_ranges(self):
+        """
+        Yields the used addresses on the network as (first, last) integer
+        ranges, in order.
+        """
+        network = self.network
+        used = self._get_used_values(int(network.network_address),
+                                     int(network.broadcast_address))
+        return collapse_ranges(used)
+
     def get_used_ipaddresses(self):
         """
-        Returns the used ipaddress on the network.
+        Yields the used ip addresses on the network in order.
         """
-        ips = self._get_used_ipaddresses()
-        used = {ipaddress.ip_address(i.ipaddress) for i in ips}
-        return used
+        return self._ip_addresses(self.get_used_ranges())
 
     def get_used_ipaddress_count(self):
         """
         Returns the number of used ipaddreses on the network.
         """
+        bitmap = self._get_usage_bitmap()
+        if bitmap is not None:
+            return bitmap.count()
         return self._get_used_ipaddresses().count()
 
-    def get_unused_ipaddresses(self):
+    def get_unused_ipaddress_count(self):
         """
-        Returns which ip-addresses on the network are unused.
+        Returns the number of unused ipaddresses on the network, without
+        enumerating the network's addresses.
         """
-        network_ips = []
-        if isinstance(self.network, ipaddress.IPv6Network):
-            # Getting all availible IPs for a ipv6 prefix can easily cause
-            # the webserver to hang due to lots and lots of IPs. Instead limit
-            # to the first 4000 hosts. Should probably be configurable.
-            for ip in self.network.hosts():
-                if len(network_ips) == 4000:
-                    break
-                network_ips.append(ip)
+        first, last = self._get_free_range()
+        if first > last:
+            return 0
+        bitmap = self._get_usage_bitmap()
+        if bitmap is not None:
+            return last - first + 1 - bitmap.count(first, last)
+        from_ip = str(self._ip_address(first))
+        to_ip = str(self._ip_address(last))
+        ips = Ipaddress.objects.filter(ipaddress__range=(from_ip, to_ip))
+        used = ips.values('ipaddress').distinct().count()
+        return last - first + 1 - used
+
+    def get_unused_ranges(self, after=None):
+        """
+        Yields the unused addresses on the network as (first, last) integer
+        ranges in order, optionally only those after the given address. The
+        ranges are the gaps between the ordered used addresses, which are
+        fetched in chunks as needed, so any network size works.
+        """
+        first, last = self._get_free_range()
+        if after is not None:
+            first = max(first, int(after) + 1)
+        if first > last:
+            return
+        bitmap = self._get_usage_bitmap()
+        if bitmap is not None:
+            used = bitmap.used(first, last)
         else:
-            network_ips = self.network.hosts()
+            used = self._get_used_values(first, last)
+        for used_ip in used:
+            if first < used_ip:
+                yield first, used_ip - 1
+            first = used_ip + 1
+        if first <= last:
+            yield first, last
+
+    def get_unused_ipaddresses(self, after=None):
+        """
+        Yields the unused ip-addresses on the network in order, optionally
+        only those after the given address.
+        """
+        return self._ip_addresses(self.get_unused_ranges(after=after))
 
-        reserved = self.get_reserved_ipaddresses()
-        used = self.get_used_ipaddresses()
-        return set(network_ips) - reserved - used
+    def _get_host_range(self):
+        """
+        Return the first and last host address in the network as integers.
+        """
+        network = self.network
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        # Same as network.hosts(), which also skips the network address, and
+        # the broadcast address for IPv4, except in the smallest networks.
+        if network.num_addresses > 2:
+            first += 1
+            if network.version == 4:
+                last -= 1
+        return first, last
+
+    def _get_free_range(self):
+        """
+        Return the first and last address in the network which is not
+        reserved, as integers. The range is empty if first > last.
+        """
+        first, last = self._get_host_range()
+        return first + self.reserved, last
+
+    def _ip_address(self, value):
+        if self.network.version == 4:
+            return ipaddress.IPv4Address(value)
+        return ipaddress.IPv6Address(value)
+
+    def _ip_addresses(self, ranges):
+        """Yields the addresses in (first, last) integer ranges, for output."""
+        ip_class = type(self.network.network_address)
+        for first, last in ranges:
+            for value in range(first, last + 1):
+                yield ip_class(value)
 
     def get_first_unused(self):
         """
         Return the first unused IP found, if any.
         """
+        first, last = self._get_free_range()
+        if first > last:
+            return None
+        bitmap = self._get_usage_bitmap()
+        if bitmap is not None:
+            ip = bitmap.first_unused(first, last)
+            if ip is not None:
+                ip = str(self._ip_address(ip))
+                if not Ipaddress.objects.filter(ipaddress=ip).exists():
+                    return ip
+            # The bitmap is stale, so rebuild it later and ask the database.
+            Network.usage_bitmaps.invalidate(self.network)
+        first_ip = str(self._ip_address(first))
+        if not Ipaddress.objects.filter(ipaddress=first_ip).exists():
+            return first_ip
+        # The first address is used, so find the end of the run of used
+        # addresses starting there. Let the database find it, using the
+        # index on ipaddress, instead of fetching all used addresses.
+        sql = """
+        SELECT host(ip + 1) FROM (
+            SELECT ip, lead(ip) OVER (ORDER BY ip) AS next
+            FROM (SELECT DISTINCT ipaddress AS ip FROM ipaddress
+                  WHERE ipaddress BETWEEN %s AND %s) AS used
+        ) AS runs
+        WHERE next IS NULL OR next <> ip + 1
+        ORDER BY ip LIMIT 1
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [first_ip, str(self._ip_address(last))])
+            row = cursor.fetchone()
+        ip = self._ip_address(row[0])
+        if int(ip) > last:
+            return None
+        return str(ip)
 
-        reserved = self.get_reserved_ipaddresses()
-        used = self.get_used_ipaddresses()
-        for ip in self.network.hosts():
-            if ip in reserved:
-                continue
-            if ip not in used:
-                return str(ip)
-        return None
+    @staticmethod
+    def get_utilization(networks=None):
+        """
+        Yield a dict with the size and the number of reserved, used and unused
+        addresses for each network, using a single query. The counts are the
+        same as from get_used_ipaddress_count() and
+        get_unused_ipaddress_count().
+        """
+        if networks is None:
+            networks = Network.objects.all()
+        # Same as _get_free_range(), but in SQL. The bounds are cast to host
+        # addresses, as inet comparison also compares the netmask.
+        small = "masklen(network.range) >= " \
+                "CASE family(network.range) WHEN 4 THEN 31 ELSE 127 END"
+        first_free = "host(network(network.range) + " \
+                     f"(CASE WHEN {small} THEN 0 ELSE 1 END + network.reserved))::inet"
+        last_free = "host(broadcast(network.range) - " \
+                    f"CASE WHEN family(network.range) = 4 AND NOT {small} " \
+                    "THEN 1 ELSE 0 END)::inet"
+        first = "host(network(network.range))::inet"
+        last = "host(broadcast(network.range))::inet"
+        select = {
+            'used': "SELECT COUNT(*) FROM ipaddress "
+                    f"WHERE ipaddress BETWEEN {first} AND {last}",
+            'used_free': "SELECT COUNT(DISTINCT ipaddress) FROM ipaddress "
+                         f"WHERE ipaddress BETWEEN {first_free} AND {last_free}",
+        }
+        networks = networks.extra(select=select)
+        for network in networks.iterator():
+            first, last = network._get_free_range()
+            free = max(0, last - first + 1)
+            size = network.network.num_addresses
+            yield {'network': network.range,
+                   'category': network.category,
+                   'location': network.location,
+                   'vlan': network.vlan,
+                   'size': size,
+                   'reserved': size - free,
+                   'used': network.used,
+                   'unused': free - network.used_free}
 
     @staticmethod
     def overlap_check(network):
@@ -501,14 +728,42 @@ class Network(models.Model):
         Check if a network overlaps existing network(s).
         Return a list of overlapped networks.
         """
-        where = [ "range::inet && inet %s" ]
+        where = [ "range && %s::inet" ]
         return Network.objects.extra(where=where, params=[str(network)])
 
+    @staticmethod
+    def find_overlaps(networks):
+        """
+        Check if any of a list of new networks overlap each other or existing
+        networks, in one sorted pass over them all.
+        Return a list of (new network, overlapped network) tuples.
+        """
+        existing = map(ipaddress.ip_network,
+                       Network.objects.values_list('range', flat=True))
+        candidates = [(net.version, int(net.network_address), net.prefixlen,
+                       int(net.broadcast_address), net, new)
+                      for new, nets in ((True, networks), (False, existing))
+                      for net in nets]
+        # Two networks either do not overlap or one contains the other, so
+        # sorted on start address and then size, a network overlaps the
+        # earlier network reaching furthest, if it reaches this one.
+        candidates.sort(key=itemgetter(0, 1, 2))
+        overlaps = []
+        cover = None
+        for version, first, _, last, net, new in candidates:
+            if cover is not None and cover[0] == version and first <= cover[3]:
+                if new:
+                    overlaps.append((net, cover[4]))
+                elif cover[5]:
+                    overlaps.append((cover[4], net))
+            if cover is None or cover[0] != version or last > cover[3]:
+                cover = (version, first, None, last, net, new)
+        return overlaps
+
     @staticmethod
     def get_network_by_ip(ip):
         """Search and return a network which contains an IP address."""
-        where = [ "inet %s <<= range::inet" ]
-        return Network.objects.extra(where=where, params=[str(ip)]).first()
+        return Network.prefix_index.get(ip)
 
 class Naptr(models.Model):
     host = models.ForeignKey(Host, on_delete=models.CASCADE, db_column='host', related_name='naptrs')
@@ -565,7 +820,7 @@ class Srv(ForwardZoneMember):
 
 class NetGroupRegexPermission(models.Model):
     group = models.CharField(max_length=80)
-    range = models.TextField(blank=True, validators=[validate_network])
+    range = CidrAddressField(blank=True, null=True, validators=[validate_network])
     regex = models.CharField(max_length=250, validators=[validate_regex])
 
     class Meta:
@@ -593,7 +848,7 @@ class NetGroupRegexPermission(models.Model):
             ).extra(
                 where=["%s ~ regex"], params=[str(hostname)]
             ).extra(
-                where=["range::inet >>= ANY (%s::inet[])"], params=[iplist]
+                where=["range >>= ANY (%s::inet[])"], params=[iplist]
             )
         return qs
 
@@ -603,9 +858,39 @@ class ModelChangeLog(models.Model):
     # user_id = models.BigIntegerField(db_index=True)
     table_name = models.CharField(max_length=132)
     table_row = models.BigIntegerField()
-    data = models.TextField()
+    data = JSONField(encoder=DjangoJSONEncoder)
+    # If data is a delta against the previous entry, see mreg.history.
+    is_delta = models.BooleanField(default=False)
     action = models.CharField(max_length=16)  # saved or deleted
     timestamp = models.DateTimeField()
 
     class Meta:
         db_table = "model_change_log"
+        indexes = [
+            models.Index(fields=['table_name', 'table_row', 'timestamp'],
+                         name='model_change_log_lookup_idx'),
+        ]
+
+    @staticmethod
+    def get_table_names():
+        """
+        Return the names of the tables with history entries.
+
+        Uses a recursive query to skip from one table name to the next in
+        model_change_log_lookup_idx, instead of reading all the entries.
+        """
+        sql = """
+        WITH RECURSIVE tables AS (
+            (SELECT table_name FROM model_change_log
+             ORDER BY table_name LIMIT 1)
+            UNION ALL
+            SELECT (SELECT table_name FROM model_change_log
+                    WHERE table_name > tables.table_name
+                    ORDER BY table_name LIMIT 1)
+            FROM tables WHERE tables.table_name IS NOT NULL
+        )
+        SELECT table_name FROM tables WHERE table_name IS NOT NULL
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            return [row[0] for row in cursor.fetchall()]
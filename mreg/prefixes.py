@@ -0,0 +1,119 @@
+import ipaddress
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+
+
+class PrefixIndex:
+    """
+    Process-wide longest prefix match of IP addresses to the objects of a
+    model with a range field, e.g. Network or ReverseZone.
+
+    The ranges are kept in one dict per prefix length, mapping the network
+    address to the object's primary key, and a lookup tries the prefix
+    lengths in use from the longest. That is at most 33 or 129 dict lookups,
+    but in practice only a handful, as few prefix lengths are in use.
+
+    Only the primary keys are kept in the index, and get() loads the object
+    by its primary key, so the index only has to change when the ranges do.
+    The index is built on the first lookup, and rebuilt when the ranges in
+    the database have changed. Each insert or delete of a row, and each
+    change of a range, bumps a counter in the prefix_index_generation table,
+    also when done by queryset updates and other processes, which is read by
+    the first lookup in each request, see recheck(), and otherwise at most
+    every PREFIX_INDEX_TTL seconds. The index is also rebuilt after
+    invalidate(), which is called when an object is created or deleted, or
+    its range is changed, in this process. Setting PREFIX_INDEX_TTL to 0
+    disables the index.
+    """
+
+    def __init__(self, model_label):
+        # The model is looked up when used, so the index can be created in
+        # the model's class body.
+        self.model_label = model_label
+        self._lock = threading.Lock()
+        self._generation = 0
+        # (tables, database generation)
+        self._cached = None
+        # When the database generation was last read by this thread.
+        self._local = threading.local()
+
+    @property
+    def model(self):
+        return apps.get_model(self.model_label)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._cached = None
+
+    def recheck(self):
+        """Read the database generation on the next lookup in this thread."""
+        self._local.checked_at = None
+
+    def _build(self):
+        tables = {4: {}, 6: {}}
+        for pk, value in self.model.objects.values_list('pk', 'range'):
+            network = ipaddress.ip_network(value)
+            table = tables[network.version].setdefault(network.prefixlen, {})
+            table[int(network.network_address)] = pk
+        return {version: sorted(table.items(), reverse=True)
+                for version, table in tables.items()}
+
+    def _get_db_generation(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT generation FROM prefix_index_generation '
+                           'WHERE table_name = %s', [self.model._meta.db_table])
+            row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _get_index(self, ttl):
+        now = time.monotonic()
+        cached = self._cached
+        checked_at = getattr(self._local, 'checked_at', None)
+        if cached is not None and checked_at is not None and now < checked_at + ttl:
+            return cached
+        # Read before building, so that changes committed while building are
+        # seen by the next check.
+        db_generation = self._get_db_generation()
+        self._local.checked_at = now
+        if cached is not None and cached[1] == db_generation:
+            return cached
+        generation = self._generation
+        cached = (self._build(), db_generation)
+        with self._lock:
+            # Only keep the result if not invalidated while building it.
+            if generation == self._generation:
+                self._cached = cached
+        return cached
+
+    def _lookup(self, ip, ttl):
+        tables, _ = self._get_index(ttl)
+        value = int(ip)
+        for prefixlen, table in tables[ip.version]:
+            hostbits = ip.max_prefixlen - prefixlen
+            pk = table.get(value >> hostbits << hostbits)
+            if pk is not None:
+                return pk
+        return None
+
+    def get(self, ip):
+        """Return the object with the longest range containing ip, or None."""
+        ttl = getattr(settings, 'PREFIX_INDEX_TTL', 60)
+        if not ttl:
+            return self._get_from_db(ip)
+        pk = self._lookup(ipaddress.ip_address(ip), ttl)
+        if pk is None:
+            return None
+        # Loaded by the primary key, so its other fields are never stale.
+        return self.model.objects.filter(pk=pk).first()
+
+    def _get_from_db(self, ip):
+        qs = self.model.objects.extra(select={'prefixlen': 'masklen(range)'},
+                                      where=["range >>= %s::inet"],
+                                      params=[str(ip)],
+                                      order_by=['-prefixlen'])
+        return qs.first()
@@ -1,20 +1,32 @@
-import functools
+import logging
+import queue
 import re
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.contrib.auth.models import Group
+from django.core.signals import request_started
+from django.db import close_old_connections, transaction
 from django.db.models.signals import post_delete, pre_delete , post_save, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
 from django_auth_ldap.backend import populate_user
 
+from mreg import history
 from mreg.api.v1.serializers import HostSerializer
-from mreg.models import (Cname, ForwardZoneMember, Host, Ipaddress,
+from mreg.api.v1.zonefile import ZoneFileCache
+from mreg.models import (Cname, ForwardZone, ForwardZoneMember, Host, Ipaddress,
         ModelChangeLog, Mx, Naptr, NameServer, PtrOverride, ReverseZone, Srv,
         Txt, Sshfp, Network, NetGroupRegexPermission)
 from rest_framework.exceptions import PermissionDenied
 
 
+logger = logging.getLogger(__name__)
+
+
 @receiver(populate_user)
 def populate_user_from_ldap(sender, signal, user=None, ldap_user=None, **kwargs):
     """Find all groups from ldap with attr LDAP_GROUP_ATTR and matching
@@ -46,8 +58,7 @@ def _del_ptr(ipaddress):
 @receiver(pre_save, sender=Ipaddress)
 def updated_ipaddress_fix_ptroverride(sender, instance, raw, using, update_fields, **kwargs):
     if instance.id:
-        oldinstance = Ipaddress.objects.get(id=instance.id)
-        _del_ptr(oldinstance.ipaddress)
+        _del_ptr(instance.get_original('ipaddress'))
     else:
         # Can only add a PtrOverride if count == 1, otherwise we can not guess which
         # one should get it.
@@ -62,47 +73,123 @@ def deleted_ipaddress_fix_ptroverride(sender, instance, using, **kwargs):
     _del_ptr(instance.ipaddress)
 
 
+def _on_commit_callbacks(connection):
+    """Yield the callbacks registered with on_commit() in the current
+    transaction. Django keeps them in a private list of tuples, with the
+    callback as the second item, so fail loudly if that changes."""
+    for entry in connection.run_on_commit:
+        if not isinstance(entry, tuple) or len(entry) not in (2, 3) or \
+                not callable(entry[1]):
+            raise RuntimeError(f"Unknown on_commit() entry: {entry!r}")
+        yield entry[1]
+
+
+class _TransactionChanges:
+    """
+    Changes collected in the current transaction, passed to flush() when it
+    is committed. One is registered with on_commit() by the first change in
+    the transaction, and Django drops it when the transaction, or the
+    savepoint it was registered in, is rolled back, along with the changes.
+    Changes added in a savepoint after the callback was registered are not
+    dropped if only that savepoint is rolled back.
+    """
+
+    def __init__(self, flush):
+        self.flush = flush
+        self.changes = {}
+
+    def __call__(self):
+        self.flush(self.changes)
+
+    @classmethod
+    @contextmanager
+    def get(cls, flush):
+        """Yield the dict of changes to be passed to flush. Outside of an
+        atomic block, they are flushed right away."""
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            changes = {}
+            yield changes
+            flush(changes)
+            return
+        for func in _on_commit_callbacks(connection):
+            if isinstance(func, cls) and func.flush == flush:
+                yield func.changes
+                return
+        callback = cls(flush)
+        transaction.on_commit(callback)
+        yield callback.changes
+
+
+class _UpdatedZones:
+    """
+    The zones with changed records in the current transaction. They are
+    marked as updated when it is committed, with one query per zone model,
+    instead of saving each zone for every changed record.
+    """
+
+    def add(self, zone):
+        with _TransactionChanges.get(self.flush) as zones:
+            zones[(type(zone), zone.pk)] = zone
+
+    @staticmethod
+    def flush(zones):
+        if not zones:
+            return
+        pks = defaultdict(list)
+        for model, pk in zones:
+            pks[model].append(pk)
+        # update() does not set the auto_now updated_at field.
+        now = timezone.now()
+        for model, model_pks in pks.items():
+            model.objects.filter(pk__in=model_pks).update(updated=True, updated_at=now)
+        cache = ZoneFileCache()
+        for zone in zones.values():
+            cache.invalidate(zone)
+
+
+_updated_zones = _UpdatedZones()
+
+
 def _common_update_zone(signal, sender, instance):
 
-    @functools.lru_cache()
-    def _get_zone_for_ip(ip):
-        return ReverseZone.get_zone_by_ip(ip)
+    def _get_old_zone(instance):
+        # Only fetch the old zone if it is not the current one.
+        old_zone_id = instance.get_original('zone_id')
+        if old_zone_id is not None and old_zone_id != instance.zone_id:
+            return ForwardZone.objects.filter(id=old_zone_id).first()
 
     zones = set()
 
     if isinstance(instance, ForwardZoneMember):
         zones.add(instance.zone)
         if signal == "pre_save" and instance.id:
-            oldzone = sender.objects.get(id=instance.id).zone
-            zones.add(oldzone)
+            zones.add(_get_old_zone(instance))
 
     if hasattr(instance, 'host'):
         zones.add(instance.host.zone)
         if signal == "pre_save" and instance.host.id:
-            oldzone = Host.objects.get(id=instance.host.id).zone
-            zones.add(oldzone)
+            zones.add(_get_old_zone(instance.host))
 
     if sender in (Ipaddress, PtrOverride):
-        zone = _get_zone_for_ip(instance.ipaddress)
+        zone = ReverseZone.get_zone_by_ip(instance.ipaddress)
         zones.add(zone)
 
     # Check if host has been renamed, and if so, update other zones
     # where the host is used. Such as reverse zones, Cname targets etc.
     if signal == "pre_save" and sender == Host and instance.id:
-        oldname = Host.objects.get(id=instance.id).name
-        if instance.name != oldname:
+        if instance.name != instance.get_original('name'):
             # XXX: add SRV in after usit-gd/mreg#192
             for model in (Cname,):
                 for i in model.objects.filter(host=instance):
                     zones.add(i.zone)
             for model in (Ipaddress, PtrOverride):
                 for i in model.objects.filter(host=instance):
-                    zones.add(_get_zone_for_ip(i.ipaddress))
+                    zones.add(ReverseZone.get_zone_by_ip(i.ipaddress))
 
     for zone in zones:
         if zone:
-            zone.updated = True
-            zone.save()
+            _updated_zones.add(zone)
 
 @receiver(pre_save, sender=Cname)
 @receiver(pre_save, sender=Ipaddress)
@@ -130,6 +217,15 @@ def updated_objects_update_zone_serial(sender, instance, raw, using, update_fiel
 def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
     _common_update_zone("post_delete", sender, instance)
 
+@receiver(post_save, sender=ForwardZone)
+@receiver(post_save, sender=ReverseZone)
+@receiver(post_delete, sender=ForwardZone)
+@receiver(post_delete, sender=ReverseZone)
+def changed_zone_invalidate_zonefile_cache(sender, instance, **kwargs):
+    # The zonefile may change while the serial number does not, e.g. when it
+    # is at the last one of the day, or is set back to an earlier one.
+    ZoneFileCache().invalidate(instance)
+
 # To log host history, an approach using post_save signals for related objects was chosen.
 # Ex: When you update an Ipaddress, the Hosts model object itself is not saved, so reading the
 # post_save signal from the Hosts model you won't get anything useful.
@@ -137,8 +233,106 @@ def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
 # Additionally, the Hosts object is saved before the related objects when creating a new host,
 # so ipaddress data isn't available at the time of post_save for the Hosts object.
 #
-# Currently saves a JSON-snapshot of all data for the host.
-# TODO: Deleting a host should probably do something. Export/delete log for that host after some time?
+# Saves the data of the host as keyframes and deltas, see mreg.history. A deleted host is
+# logged with a snapshot taken before it was deleted.
+
+
+def _get_host_history_data(host):
+    hostdata = HostSerializer(host).data
+
+    # Cleaning up data from related tables
+    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
+    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
+    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
+    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
+    return hostdata
+
+
+def save_host_history(changes):
+    """Save a snapshot of each host in changes, a dict of host id to
+    (action, timestamp, data), to the history log. Hosts which no longer
+    exist are logged with data, the snapshot taken before the host was
+    deleted."""
+    with transaction.atomic():
+        # Lock the hosts, so that concurrent saves of a host's history are
+        # appended to its chain of deltas one at a time.
+        hosts = list(Host.objects.filter(pk__in=changes).select_for_update()
+                     .prefetch_related('ipaddresses', 'cnames', 'mxs', 'txts',
+                                       'ptr_overrides'))
+        snapshots = {host.pk: _get_host_history_data(host) for host in hosts}
+        for host_id, (action, timestamp, data) in changes.items():
+            if data is not None:
+                snapshots.setdefault(host_id, data)
+        latest = history.get_latest('host', list(snapshots))
+        entries = []
+        for host_id, data in snapshots.items():
+            action, timestamp, _ = changes[host_id]
+            entries.append(history.make_entry(latest, 'host', host_id, data,
+                                              action=action,
+                                              timestamp=timestamp))
+        ModelChangeLog.objects.bulk_create(entries)
+
+
+class _HostHistory:
+    """
+    The hosts with changed records in the current transaction. A snapshot of
+    each is saved once when the transaction is committed, instead of for
+    every changed record while the request waits. Deleted hosts are gone
+    by then, so their snapshots are taken before they are deleted.
+
+    With HOST_HISTORY_IN_BACKGROUND set, the snapshots are saved by a
+    background thread. Snapshots not saved when the process exits are lost.
+    """
+
+    _queue = None
+    _queue_lock = threading.Lock()
+
+    def add(self, host_id, action, data=None):
+        with _TransactionChanges.get(self.flush) as changes:
+            # Keep the snapshot of a deleted host, as its records are
+            # deleted after it.
+            if data is None and host_id in changes:
+                data = changes[host_id][2]
+            changes[host_id] = (action, timezone.now(), data)
+
+    def add_deleted(self, host):
+        self.add(host.pk, 'deleted', _get_host_history_data(host))
+
+    def flush(self, changes):
+        if not changes:
+            return
+        if getattr(settings, 'HOST_HISTORY_IN_BACKGROUND', False):
+            self._get_queue().put(changes)
+            return
+        # The changes are already committed, so do not fail the request.
+        try:
+            save_host_history(changes)
+        except Exception:
+            logger.exception('Could not save host history')
+
+    @classmethod
+    def _get_queue(cls):
+        with cls._queue_lock:
+            if cls._queue is None:
+                cls._queue = queue.Queue()
+                threading.Thread(target=cls._worker, args=(cls._queue, ),
+                                 name='host-history', daemon=True).start()
+        return cls._queue
+
+    @staticmethod
+    def _worker(changes_queue):
+        while True:
+            changes = changes_queue.get()
+            try:
+                save_host_history(changes)
+            except Exception:
+                logger.exception('Could not save host history')
+            finally:
+                # Like at the end of a request.
+                close_old_connections()
+
+
+_host_history = _HostHistory()
 
 
 @receiver(post_save, sender=PtrOverride)
@@ -148,19 +342,7 @@ def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
 @receiver(post_save, sender=Naptr)
 def save_host_history_on_save(sender, instance, created, **kwargs):
     """Receives post_save signal for models that have a ForeignKey to Hosts and updates the host history log."""
-    hostdata = HostSerializer(Host.objects.get(pk=instance.host_id)).data
-
-    # Cleaning up data from related tables
-    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
-    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
-    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
-    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
-    new_log_entry = ModelChangeLog(table_name='host',
-                                   table_row=hostdata['id'],
-                                   data=hostdata,
-                                   action='saved',
-                                   timestamp=timezone.now())
-    new_log_entry.save()
+    _host_history.add(instance.host_id, 'saved')
 
 
 @receiver(post_delete, sender=PtrOverride)
@@ -170,20 +352,7 @@ def save_host_history_on_save(sender, instance, created, **kwargs):
 @receiver(post_delete, sender=Naptr)
 def save_host_history_on_delete(sender, instance, **kwargs):
     """Receives post_delete signal for models that have a ForeignKey to Hosts and updates the host history log."""
-    hostdata = HostSerializer(Host.objects.get(pk=instance.host_id)).data
-
-    # Cleaning up data from related tables
-    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
-    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
-    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
-    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
-
-    new_log_entry = ModelChangeLog(table_name='host',
-                                   table_row=hostdata['id'],
-                                   data=hostdata,
-                                   action='deleted',
-                                   timestamp=timezone.now())
-    new_log_entry.save()
+    _host_history.add(instance.host_id, 'deleted')
 
 
 @receiver(pre_delete, sender=Ipaddress)
@@ -212,11 +381,69 @@ def prevent_nameserver_deletion(sender, instance, using, **kwargs):
             raise PermissionDenied(detail='This host is a nameserver and cannot be deleted until' \
                                     'it has been removed from all zones its setup as a nameserver')
 
+
+@receiver(pre_delete, sender=Host)
+def save_host_history_on_host_delete(sender, instance, **kwargs):
+    """Receives pre_delete signal for Hosts, and takes a snapshot for the host
+    history log while the host and its records still exist."""
+    _host_history.add_deleted(instance)
+
+@receiver(post_save, sender=Network)
+@receiver(post_save, sender=ReverseZone)
+def invalidate_prefix_index_on_save(sender, instance, created, **kwargs):
+    # Only the ranges are in the index, so other changes, like the serial
+    # number of a zone, leave it alone.
+    if created or instance.range != instance.get_original('range'):
+        sender.prefix_index.invalidate()
+
+
+@receiver(post_delete, sender=Network)
+@receiver(post_delete, sender=ReverseZone)
+def invalidate_prefix_index(sender, instance, **kwargs):
+    sender.prefix_index.invalidate()
+
+
+@receiver(request_started)
+def recheck_prefix_indexes(sender, **kwargs):
+    Network.prefix_index.recheck()
+    ReverseZone.prefix_index.recheck()
+
+
+@receiver(post_save, sender=Network)
+@receiver(post_delete, sender=Network)
+def invalidate_network_usage_bitmaps(sender, instance, **kwargs):
+    Network.usage_bitmaps.invalidate()
+
+
+# Keep the cached network usage bitmaps up to date. Only apply the changes
+# when committed, as a rollback does not send any signals.
+@receiver(post_save, sender=Ipaddress)
+def updated_ipaddress_update_usage_bitmaps(sender, instance, created, **kwargs):
+    if not Network.usage_bitmaps:
+        return
+    # The original is not updated until after post_save.
+    old = None if created else instance.get_original('ipaddress')
+    new = instance.ipaddress
+
+    def update():
+        if old is not None:
+            Network.usage_bitmaps.remove(old)
+        Network.usage_bitmaps.add(new)
+
+    transaction.on_commit(update)
+
+
+@receiver(post_delete, sender=Ipaddress)
+def deleted_ipaddress_update_usage_bitmaps(sender, instance, **kwargs):
+    ip = instance.ipaddress
+    transaction.on_commit(lambda: Network.usage_bitmaps.remove(ip))
+
+
 @receiver(post_delete, sender=Network)
 def cleanup_network_permissions(sender, instance, **kwargs):
     """Remove any permissions equal to or smaller than the newly deleted
        Network's range."""
 
     NetGroupRegexPermission.objects.extra(
-            where=["range::inet <<= %s::inet"], params=[str(instance.range)]
+            where=["range <<= %s::inet"], params=[str(instance.range)]
             ).delete()
@@ -1,10 +1,22 @@
+import ipaddress
+import os
+import tempfile
+
+from datetime import timedelta
+from io import StringIO
+
 from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import connection
 from django.test import TestCase
 from django.utils import timezone
 
+from mreg import history
 from mreg.models import (ForwardZone, Host, Ipaddress, NameServer, Network, ReverseZone,
                          PtrOverride, Txt, Sshfp, Cname, Naptr, Srv, ModelChangeLog,
                          NetGroupRegexPermission, )
+from mreg.usage import UsageBitmap
+from mreg.utils import idna_encode, qualify
 from rest_framework.exceptions import PermissionDenied
 
 
@@ -45,6 +57,33 @@ class ModelChangeLogTestCase(TestCase):
         new_count = ModelChangeLog.objects.count()
         self.assertNotEqual(old_count, new_count)
 
+    def test_model_history_delta(self):
+        """Test that a delta restores the data it was made from."""
+        new = dict(self.log_data, ttl=600, txts=['some text'])
+        del new['loc']
+        delta = history.diff(self.log_data, new)
+        self.assertEqual(delta, {'set': {'ttl': 600, 'txts': ['some text']},
+                                 'unset': ['loc']})
+        self.assertEqual(history.patch(self.log_data, delta), new)
+        self.assertEqual(history.diff(new, new), {})
+
+    def test_model_history_after_string_keyframe(self):
+        """Test that a legacy entry with a string is followed by a keyframe."""
+        self.log_entry_one.data = 'not json'
+        clean_and_save(self.log_entry_one)
+        latest = history.get_latest('Hosts', [self.host_one.id])
+        self.assertEqual(latest, {self.host_one.id: ('not json', 1)})
+        entry = history.make_entry(latest, 'Hosts', self.host_one.id, self.log_data,
+                                   action='saved', timestamp=timezone.now())
+        self.assertFalse(entry.is_delta)
+        self.assertEqual(entry.data, self.log_data)
+        entry.save()
+        entry = history.make_entry(history.get_latest('Hosts', [self.host_one.id]),
+                                   'Hosts', self.host_one.id, dict(self.log_data, ttl=600),
+                                   action='saved', timestamp=timezone.now())
+        self.assertTrue(entry.is_delta)
+        self.assertEqual(entry.data, {'set': {'ttl': 600}})
+
 
 class ModelSrvTestCase(TestCase):
     """This class defines the test suite for the Srv model."""
@@ -230,6 +269,23 @@ class ModelHostsTestCase(TestCase):
             self.host_one.loc = loc
             clean_and_save(self.host_one)
 
+    def test_model_host_original_values(self):
+        """Test that the values in the database are kept for signal handlers."""
+        self.assertIsNone(self.host_one.get_original('name'))
+        clean_and_save(self.host_one)
+        self.host_one.name = 'some-new-host.example.org'
+        self.assertEqual(self.host_one.get_original('name'), 'some-host.example.org')
+        clean_and_save(self.host_one)
+        self.assertEqual(self.host_one.get_original('name'), 'some-new-host.example.org')
+        host = Host.objects.get(pk=self.host_one.pk)
+        Host.objects.filter(pk=host.pk).update(name='other-host.example.org')
+        self.assertEqual(host.get_original('name'), 'some-new-host.example.org')
+        host.refresh_from_db()
+        self.assertEqual(host.get_original('name'), 'other-host.example.org')
+        # Deferred fields are fetched when needed
+        host = Host.objects.only('contact').get(pk=host.pk)
+        self.assertEqual(host.get_original('name'), 'other-host.example.org')
+
 
 class ModelNameServerTestCase(TestCase):
     """This class defines the test suite for the NameServer model."""
@@ -343,6 +399,29 @@ class ModelNetworkTestCase(TestCase):
         new_count = Network.objects.count()
         self.assertNotEqual(old_count, new_count)
 
+    def test_model_address_ranges(self):
+        """Test that the reserved, used and unused addresses are given as
+        integer ranges."""
+        clean_and_save(self.network_sample)
+        first = int(self.network_sample.network.network_address)
+        self.assertEqual(self.network_sample.get_reserved_ranges(),
+                         [(first, first + 3), (first + 4095, first + 4095)])
+        host = Host.objects.create(name='host.example.org', contact='mail@example.org')
+        for ip in ('10.0.0.5', '10.0.0.6', '10.0.0.8'):
+            Ipaddress.objects.create(host=host, ipaddress=ip)
+        self.assertEqual(list(self.network_sample.get_used_ranges()),
+                         [(first + 5, first + 6), (first + 8, first + 8)])
+        self.assertEqual(list(map(str, self.network_sample.get_used_ipaddresses())),
+                         ['10.0.0.5', '10.0.0.6', '10.0.0.8'])
+        self.assertEqual(list(self.network_sample.get_unused_ranges()),
+                         [(first + 4, first + 4), (first + 7, first + 7),
+                          (first + 9, first + 4094)])
+        self.assertEqual(list(self.network_sample.get_unused_ranges(after=first + 8)),
+                         [(first + 9, first + 4094)])
+        clean_and_save(self.network_ipv6_sample)
+        first = int(self.network_ipv6_sample.network.network_address)
+        self.assertEqual(self.network_ipv6_sample.get_reserved_ranges(), [(first, first + 3)])
+
 
 class ModelIpaddressTestCase(TestCase):
     """This class defines the test suite for the Ipaddress model."""
@@ -763,6 +842,35 @@ class ModelReverseZoneTestCase(TestCase):
         self.assertEqual(context.exception.messages,
                          ['Maximum CIDR for RFC 2317 is 25'])
 
+    def test_model_get_ipaddresses(self):
+        """Test that PTR records are ordered by ip and PtrOverrides are used."""
+        clean_and_save(self.zone_v4)
+        zone = ForwardZone.objects.create(name='example.org',
+                                          primary_ns='ns.example.org',
+                                          email='hostmaster@example.org')
+        hosts = {}
+        for name in ('a', 'b', 'c', 'd'):
+            hosts[name] = Host.objects.create(name=f'{name}.example.org',
+                                              contact='mail@example.org',
+                                              zone=zone)
+        Ipaddress.objects.create(host=hosts['a'], ipaddress='10.0.0.10')
+        Ipaddress.objects.create(host=hosts['b'], ipaddress='10.0.0.2')
+        # Shared ip without a PtrOverride is skipped
+        Ipaddress.objects.create(host=hosts['a'], ipaddress='10.0.0.3')
+        Ipaddress.objects.create(host=hosts['b'], ipaddress='10.0.0.3')
+        PtrOverride.objects.filter(ipaddress='10.0.0.3').delete()
+        # Shared ip with a PtrOverride, which is used only once
+        Ipaddress.objects.create(host=hosts['c'], ipaddress='10.0.0.4')
+        Ipaddress.objects.create(host=hosts['d'], ipaddress='10.0.0.4')
+        PtrOverride.objects.filter(ipaddress='10.0.0.4').update(host=hosts['d'])
+        # PtrOverride without any Ipaddress
+        PtrOverride.objects.create(host=hosts['c'], ipaddress='10.0.0.1')
+        result = [(str(ip), name) for ip, ttl, name in self.zone_v4.get_ipaddresses()]
+        self.assertEqual(result, [('10.0.0.1', 'c.example.org'),
+                                  ('10.0.0.2', 'b.example.org'),
+                                  ('10.0.0.4', 'd.example.org'),
+                                  ('10.0.0.10', 'a.example.org')])
+
 
 class NameServerDeletionTestCase(TestCase):
     """This class defines the test suite for the NameServer model."""
@@ -828,6 +936,21 @@ class NetGroupRegexPermissionTestCase(TestCase):
         clean_and_save(perm)
         self.assertGreater(NetGroupRegexPermission.objects.count(), old_count)
 
+    def test_model_blank_range(self):
+        perm = NetGroupRegexPermission(group='testgroup',
+                                       range='',
+                                       regex=r'.*\.example\.org$')
+        clean_and_save(perm)
+        self.assertEqual(NetGroupRegexPermission.objects.get(id=perm.id).range, '')
+        qs = NetGroupRegexPermission.find_perm('testgroup', 'www.example.org', '10.0.0.1')
+        self.assertFalse(qs.exists())
+        # Still unique per group
+        perm = NetGroupRegexPermission(group='testgroup',
+                                       range='',
+                                       regex=r'.*\.example\.com$')
+        with self.assertRaises(ValidationError):
+            perm.full_clean()
+
     def test_model_find_perm(self):
         perm = NetGroupRegexPermission(group='testgroup',
                                        range='10.0.0.0/25',
@@ -882,3 +1005,296 @@ class NetGroupRegexPermissionTestCase(TestCase):
         self.assertEqual(NetGroupRegexPermission.objects.first(), v6perm)
         self.network_v6.delete()
         self.assertEqual(NetGroupRegexPermission.objects.count(), 0)
+
+
+class ExportZonefilesCommandTestCase(TestCase):
+    """This class defines the test suite for the export_zonefiles command."""
+
+    def setUp(self):
+        self.target = tempfile.TemporaryDirectory()
+        self.addCleanup(self.target.cleanup)
+        self.zone = ForwardZone.objects.create(name='example.org',
+                                               primary_ns='ns.example.org',
+                                               email='hostmaster@example.org')
+        # Allow update_serialno() to update the serial number.
+        ForwardZone.objects.filter(id=self.zone.id).update(
+            serialno_updated_at=timezone.now() - timedelta(minutes=5))
+        self.path = os.path.join(self.target.name, 'example.org')
+
+    def _export(self, *args):
+        out = StringIO()
+        call_command('export_zonefiles', self.target.name, '--workers=1', *args,
+                     stdout=out)
+        return out.getvalue()
+
+    def test_export_updated_zones(self):
+        output = self._export()
+        self.assertIn('example.org: exported', output)
+        self.zone.refresh_from_db()
+        self.assertFalse(self.zone.updated)
+        with open(self.path) as f:
+            self.assertIn(f'{self.zone.serialno}    ; Serialnumber', f.read())
+        # Not updated, so not selected again
+        self.assertNotIn('example.org', self._export())
+
+    def test_export_all_only_rewrites_changed_serials(self):
+        self._export()
+        output = self._export('--all')
+        self.assertIn('example.org: unchanged serial', output)
+        os.unlink(self.path)
+        self.assertIn('example.org: exported', self._export('--all'))
+        self.assertTrue(os.path.exists(self.path))
+
+
+class UtilsTestCase(TestCase):
+    """This class defines the test suite for the zonefile name helpers."""
+
+    def test_qualify(self):
+        self.assertEqual(qualify('example.org', 'example.org'), '')
+        self.assertEqual(qualify('host.example.org', 'example.org'), 'host')
+        self.assertEqual(qualify('host.example.org', 'example.org', shortform=False),
+                         'host.example.org.')
+        self.assertEqual(qualify('fooexample.org', 'example.org'), 'fooexample.org.')
+        self.assertEqual(qualify('host.example.com', 'example.org'), 'host.example.com.')
+        self.assertEqual(qualify('host.example.com.', 'example.org'), 'host.example.com.')
+
+    def test_idna_encode(self):
+        self.assertEqual(idna_encode('*.example.org'), '*.example.org')
+        self.assertEqual(idna_encode('blåbær.*.example.org'), 'xn--blbr-roah.*.example.org')
+
+
+class ZonefileWorkerCommandTestCase(TestCase):
+    """This class defines the test suite for the zonefile_worker command."""
+
+    def setUp(self):
+        self.zone = ForwardZone.objects.create(name='example.org',
+                                               primary_ns='ns.example.org',
+                                               email='hostmaster@example.org')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _run(self):
+        out = StringIO()
+        call_command('zonefile_worker', '--once', '--debounce=30',
+                     f'--directory={self.directory.name}', stdout=out)
+        self.zone.refresh_from_db()
+        return out.getvalue()
+
+    def test_worker_exports_updated_zone(self):
+        old_serialno = self.zone.serialno
+        ForwardZone.objects.filter(id=self.zone.id).update(
+            updated_at=timezone.now() - timedelta(minutes=1),
+            serialno_updated_at=timezone.now() - timedelta(minutes=5))
+        self.assertIn('example.org: serial', self._run())
+        self.assertFalse(self.zone.updated)
+        self.assertNotEqual(self.zone.serialno, old_serialno)
+        with open(os.path.join(self.directory.name, 'example.org')) as f:
+            self.assertIn(f'{self.zone.serialno}    ; Serialnumber', f.read())
+        # Not updated, so nothing to do
+        self.assertEqual(self._run(), '')
+
+    def test_worker_needs_output(self):
+        with self.settings(ZONEFILE_CACHE_DIR=None):
+            with self.assertRaises(CommandError):
+                call_command('zonefile_worker', '--once', stdout=StringIO())
+        self.zone.refresh_from_db()
+        self.assertTrue(self.zone.updated)
+
+    def test_worker_debounces_changes(self):
+        ForwardZone.objects.filter(id=self.zone.id).update(
+            serialno_updated_at=timezone.now() - timedelta(minutes=2))
+        self.assertEqual(self._run(), '')
+        self.assertTrue(self.zone.updated)
+
+
+class NetworkUtilizationCommandTestCase(TestCase):
+    """This class defines the test suite for the network_utilization command."""
+
+    def test_network_utilization(self):
+        Network.objects.create(range='10.0.0.0/24', category='a')
+        Network.objects.create(range='10.0.1.0/24', category='b')
+        host = Host.objects.create(name='host.example.org', contact='mail@example.org')
+        Ipaddress.objects.create(host=host, ipaddress='10.0.0.10')
+        out = StringIO()
+        call_command('network_utilization', '--category=a', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split(), ['10.0.0.0/24', '256', '5', '1', '250', '0.4'])
+
+
+class PrefixIndexTestCase(TestCase):
+    """This class defines the test suite for the lookup of the network or
+    reverse zone of an IP address."""
+
+    def setUp(self):
+        # As in a new request.
+        Network.prefix_index.recheck()
+        ReverseZone.prefix_index.recheck()
+
+    def test_longest_prefix_wins(self):
+        zone24 = ReverseZone.objects.create(name='0.10.in-addr.arpa',
+                                            primary_ns='ns.example.org',
+                                            email='hostmaster@example.org')
+        zone25 = ReverseZone.objects.create(name='0/25.0.0.10.in-addr.arpa',
+                                            primary_ns='ns.example.org',
+                                            email='hostmaster@example.org')
+        self.assertEqual(str(zone24.range), '10.0.0.0/16')
+        self.assertEqual(str(zone25.range), '10.0.0.0/25')
+        self.assertEqual(ReverseZone.get_zone_by_ip('10.0.0.10'), zone25)
+        self.assertEqual(ReverseZone.get_zone_by_ip('10.0.0.200'), zone24)
+        self.assertIsNone(ReverseZone.get_zone_by_ip('10.1.0.10'))
+
+    def test_invalidated_on_save_and_delete(self):
+        self.assertIsNone(Network.get_network_by_ip('10.0.0.10'))
+        network = Network.objects.create(range='10.0.0.0/24')
+        self.assertEqual(Network.get_network_by_ip('10.0.0.10'), network)
+        network.delete()
+        self.assertIsNone(Network.get_network_by_ip('10.0.0.10'))
+
+    def test_stale_index(self):
+        """Changes which are not signalled, as if done by another process,
+        must not give wrong answers."""
+        network = Network.objects.create(range='10.0.0.0/24')
+        self.assertEqual(Network.get_network_by_ip('10.0.0.10'), network)
+        Network.objects.filter(pk=network.pk).update(range='10.0.1.0/24')
+        Network.prefix_index.recheck()
+        self.assertIsNone(Network.get_network_by_ip('10.0.0.10'))
+        self.assertEqual(Network.get_network_by_ip('10.0.1.10'), network)
+
+    def test_created_without_signal(self):
+        """Objects created without a signal, as if by another process, must
+        be found, also when they are more specific than a found object."""
+        network = Network.objects.create(range='10.0.0.0/16')
+        self.assertEqual(Network.get_network_by_ip('10.0.0.10'), network)
+        self.assertIsNone(Network.get_network_by_ip('10.1.0.10'))
+        Network.objects.bulk_create([Network(range='10.0.0.0/24'),
+                                     Network(range='10.1.0.0/24')])
+        Network.prefix_index.recheck()
+        self.assertEqual(str(Network.get_network_by_ip('10.0.0.10').range), '10.0.0.0/24')
+        self.assertEqual(str(Network.get_network_by_ip('10.1.0.10').range), '10.1.0.0/24')
+        self.assertEqual(Network.get_network_by_ip('10.0.1.10'), network)
+
+    def test_one_query_when_checked(self):
+        """Only the first lookup in a request checks for changes, and the
+        object is then loaded by its primary key."""
+        network = Network.objects.create(range='10.0.0.0/24')
+        self.assertEqual(Network.get_network_by_ip('10.0.0.10'), network)
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            found = Network.get_network_by_ip('10.0.0.20')
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('prefix_index_generation', queries[0])
+        self.assertEqual(found, network)
+        self.assertEqual(found.range, network.range)
+
+    def test_kept_when_range_unchanged(self):
+        network = Network.objects.create(range='10.0.0.0/24')
+        self.assertEqual(Network.get_network_by_ip('10.0.0.10'), network)
+        cached = Network.prefix_index._cached
+        network.description = 'changed'
+        network.save()
+        self.assertIs(Network.prefix_index._cached, cached)
+        network.range = '10.0.1.0/24'
+        network.save()
+        self.assertIsNone(Network.prefix_index._cached)
+
+    def test_changed_without_signal(self):
+        """Other changes to the objects are seen by the next request."""
+        network = Network.objects.create(range='10.0.0.0/24')
+        self.assertEqual(Network.get_network_by_ip('10.0.0.10').description, '')
+        Network.objects.filter(pk=network.pk).update(description='changed')
+        Network.prefix_index.recheck()
+        self.assertEqual(Network.get_network_by_ip('10.0.0.10').description, 'changed')
+
+    def test_disabled(self):
+        network = Network.objects.create(range='10.0.0.0/24')
+        with self.settings(PREFIX_INDEX_TTL=0):
+            self.assertEqual(Network.get_network_by_ip('10.0.0.10'), network)
+
+
+class ImportNetworksCommandTestCase(TestCase):
+    """This class defines the test suite for the import_networks command."""
+
+    def test_import_networks(self):
+        Network.objects.create(range='10.0.0.0/24')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'networks.csv')
+            with open(path, 'w') as f:
+                f.write('range,category\n10.0.1.0/24,a\n10.0.2.0/24,b\n')
+            out = StringIO()
+            call_command('import_networks', path, stdout=out)
+            self.assertEqual(out.getvalue().strip(), 'Created 2 networks')
+            self.assertEqual(Network.objects.get(range='10.0.2.0/24').category, 'b')
+            with open(path, 'w') as f:
+                f.write('range\n10.0.3.0/24\n10.0.0.0/23\n')
+            with self.assertRaises(CommandError):
+                call_command('import_networks', path, stdout=out)
+        self.assertEqual(Network.objects.count(), 3)
+
+
+class NetworkUsageBitmapTestCase(TestCase):
+    """This class defines the test suite for the cached usage bitmaps of
+    networks."""
+
+    def setUp(self):
+        Network.usage_bitmaps.invalidate()
+        self.network = Network.objects.create(range='10.0.0.0/24')
+        self.host = Host.objects.create(name='host.example.org', contact='mail@example.org')
+        for ip in ('10.0.0.4', '10.0.0.5', '10.0.0.7'):
+            Ipaddress.objects.create(host=self.host, ipaddress=ip)
+        # An address used by two hosts is counted twice as used.
+        host2 = Host.objects.create(name='host2.example.org', contact='mail@example.org')
+        Ipaddress.objects.create(host=host2, ipaddress='10.0.0.5')
+
+    def tearDown(self):
+        Network.usage_bitmaps.invalidate()
+
+    def test_bitmap(self):
+        network = ipaddress.ip_network('10.0.0.0/28')
+        first = int(network.network_address)
+        bitmap = UsageBitmap(network, [first + 1, first + 2, first + 2, first + 9])
+        self.assertEqual(bitmap.count(), 4)
+        self.assertEqual(bitmap.count(first + 2, first + 9), 2)
+        self.assertEqual(bitmap.first_unused(first + 1, first + 14), first + 3)
+        self.assertEqual(list(bitmap.used(first + 2, first + 11)), [first + 2, first + 9])
+        bitmap.remove(first + 2)
+        bitmap.remove(first + 2)
+        self.assertEqual(bitmap.first_unused(first + 1, first + 14), first + 2)
+        self.assertIsNone(bitmap.first_unused(first + 1, first + 1))
+        self.assertFalse(UsageBitmap.supports(ipaddress.ip_network('10.0.0.0/15')))
+
+    def test_same_as_database(self):
+        without = (self.network.get_used_ipaddress_count(),
+                   self.network.get_unused_ipaddress_count(),
+                   list(self.network.get_unused_ipaddresses()),
+                   self.network.get_first_unused())
+        with self.settings(NETWORK_USAGE_CACHE_TTL=60):
+            self.assertIsNotNone(self.network._get_usage_bitmap())
+            cached = (self.network.get_used_ipaddress_count(),
+                      self.network.get_unused_ipaddress_count(),
+                      list(self.network.get_unused_ipaddresses()),
+                      self.network.get_first_unused())
+        self.assertEqual(without, cached)
+        self.assertEqual(cached[:2], (4, 248))
+
+    def test_incremental_update(self):
+        with self.settings(NETWORK_USAGE_CACHE_TTL=60):
+            self.assertEqual(self.network.get_used_ipaddress_count(), 4)
+            Network.usage_bitmaps.add('10.0.0.6')
+            Network.usage_bitmaps.remove('10.0.0.4')
+            self.assertEqual(self.network.get_used_ipaddress_count(), 4)
+            self.assertEqual(list(self.network.get_unused_ipaddresses())[:2],
+                             [ipaddress.ip_address('10.0.0.4'),
+                              ipaddress.ip_address('10.0.0.8')])
+
+    def test_stale_first_unused(self):
+        with self.settings(NETWORK_USAGE_CACHE_TTL=60):
+            self.assertEqual(self.network.get_first_unused(), '10.0.0.6')
+            # Not committed, so the bitmap is not updated.
+            Ipaddress.objects.create(host=self.host, ipaddress='10.0.0.6')
+            self.assertEqual(self.network.get_first_unused(), '10.0.0.8')
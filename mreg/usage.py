@@ -0,0 +1,161 @@
+import ipaddress
+import threading
+import time
+
+from collections import Counter
+
+from django.conf import settings
+
+from mreg.utils import ip_to_int
+
+
+class UsageBitmap:
+    """
+    The used addresses of an IPv4 network as a bitmap, with one bit for each
+    address in the network, set if the address is used. A /16 takes 8 KiB.
+
+    Addresses are given and returned as integers.
+    """
+
+    MAX_ADDRESSES = 2**16
+
+    def __init__(self, network, used=()):
+        self.first = int(network.network_address)
+        self.last = int(network.broadcast_address)
+        self.bits = bytearray((network.num_addresses + 7) // 8)
+        # Addresses can be used by more than one host. Count the extra uses,
+        # so the number of used addresses is the same as in the database.
+        self.extra = Counter()
+        for value in used:
+            self.add(value)
+
+    @classmethod
+    def supports(cls, network):
+        return network.version == 4 and network.num_addresses <= cls.MAX_ADDRESSES
+
+    def add(self, value):
+        i = value - self.first
+        mask = 1 << (i & 7)
+        if self.bits[i >> 3] & mask:
+            self.extra[i] += 1
+        else:
+            self.bits[i >> 3] |= mask
+
+    def remove(self, value):
+        i = value - self.first
+        if self.extra[i]:
+            self.extra[i] -= 1
+        else:
+            self.bits[i >> 3] &= ~(1 << (i & 7))
+
+    def count(self, first=None, last=None):
+        """Return the number of used addresses from first to last."""
+        if first is None and last is None:
+            return _popcount(self.bits) + sum(self.extra.values())
+        first = self.first if first is None else first
+        last = self.last if last is None else last
+        if first > last:
+            return 0
+        value = int.from_bytes(self.bits, 'little') >> (first - self.first)
+        return _popcount_int(value & ((1 << (last - first + 1)) - 1))
+
+    def first_unused(self, first, last):
+        """Return the first unused address from first to last, or None."""
+        i, end = first - self.first, last - self.first
+        while i <= end:
+            byte = i >> 3
+            # Handle the bits before i as used.
+            b = self.bits[byte] | ((1 << (i & 7)) - 1)
+            if b != 0xff:
+                i = (byte << 3) + (~b & (b + 1)).bit_length() - 1
+                return i + self.first if i <= end else None
+            # Skip the following bytes where all addresses are used.
+            rest = self.bits[byte + 1:]
+            i = (byte + 1 + len(rest) - len(rest.lstrip(b'\xff'))) << 3
+        return None
+
+    def used(self, first, last):
+        """Yield the used addresses from first to last, in order."""
+        bits = self.bits
+        i, end = first - self.first, last - self.first
+        while i <= end:
+            b = bits[i >> 3]
+            if not b and not i & 7:
+                i += 8
+                continue
+            if b >> (i & 7) & 1:
+                yield i + self.first
+            i += 1
+
+
+def _popcount(data):
+    return _popcount_int(int.from_bytes(data, 'little'))
+
+
+def _popcount_int(value):
+    return bin(value).count('1')
+
+
+class UsageBitmapCache:
+    """
+    Process-wide cache of the UsageBitmaps of IPv4 networks up to /16,
+    updated when ipaddresses are committed or deleted in this process.
+
+    Changes done by other processes, or by queryset updates, are seen when
+    the bitmap is rebuilt after NETWORK_USAGE_CACHE_TTL seconds, so the
+    users must handle a stale bitmap. Setting it to 0, the default, disables
+    the cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (network address, prefix length) -> (bitmap, expires)
+        self._bitmaps = {}
+
+    def __bool__(self):
+        return bool(self._bitmaps)
+
+    def get(self, network, get_used):
+        """Return the bitmap for network, or None if not cached. get_used is
+        called to get the used addresses when the bitmap is built."""
+        ttl = getattr(settings, 'NETWORK_USAGE_CACHE_TTL', 0)
+        if not ttl or not UsageBitmap.supports(network):
+            return None
+        key = (int(network.network_address), network.prefixlen)
+        entry = self._bitmaps.get(key)
+        if entry is not None and time.monotonic() < entry[1]:
+            return entry[0]
+        used = map(ip_to_int, get_used())
+        bitmap = UsageBitmap(network, used)
+        with self._lock:
+            self._bitmaps[key] = (bitmap, time.monotonic() + ttl)
+        return bitmap
+
+    def invalidate(self, network=None):
+        with self._lock:
+            if network is None:
+                self._bitmaps.clear()
+            else:
+                key = (int(network.network_address), network.prefixlen)
+                self._bitmaps.pop(key, None)
+
+    def _find(self, value):
+        for prefixlen in range(32, 15, -1):
+            hostbits = 32 - prefixlen
+            entry = self._bitmaps.get((value >> hostbits << hostbits, prefixlen))
+            if entry is not None:
+                yield entry[0]
+
+    def add(self, ip):
+        self._update(ip, UsageBitmap.add)
+
+    def remove(self, ip):
+        self._update(ip, UsageBitmap.remove)
+
+    def _update(self, ip, method):
+        ip = ipaddress.ip_address(ip)
+        if ip.version != 4 or not self._bitmaps:
+            return
+        with self._lock:
+            for bitmap in self._find(int(ip)):
+                method(bitmap, int(ip))
@@ -1,6 +1,7 @@
+import functools
 import idna
 import ipaddress
-import re
+import socket
 import time
 
 
@@ -25,24 +26,51 @@ def qualify(name, zone, shortform=True):
     :param shortform: Wheter to remove zone from name, or not
     :return: String with punctuation appended or unchanged
     """
-    if name.endswith(zone) and shortform:
-        name = re.sub('(.?%s)$' % zone, '', name)
-    elif not name.endswith("."):
+    # Called for most records in a zonefile export, often with the same
+    # name, so keep the most recent results.
+    return _qualify(name, zone, shortform)
+
+
+@functools.lru_cache(maxsize=2**16)
+def _qualify(name, zone, shortform):
+    if shortform:
+        if name == zone:
+            return ''
+        if name.endswith(zone) and name[-len(zone) - 1] == '.':
+            return name[:-len(zone) - 1]
+    if not name.endswith('.'):
         name += '.'
     return name
 
+
+try:
+    _isascii = str.isascii
+except AttributeError:
+    # Python < 3.7
+    def _isascii(value):
+        return len(value) == len(value.encode('utf-8'))
+
+
 def idna_encode(entry):
     """
     Encodes the entry to an IDNA entry.
     :param entry: Entry to encode
     :return: String encoded to IDNA and converted to utf-8
     """
+    # Most names are plain ascii, and checking that is cheaper than a
+    # lookup in the cache.
+    if _isascii(entry):
+        return entry
+    return _idna_encode(entry)
+
+
+@functools.lru_cache(maxsize=2**16)
+def _idna_encode(entry):
     res = []
     # idna encode each label, and only those who needs it, as
     # e.g. the idna module doesn't like to encode "*".
     for label in entry.split("."):
-        # convert to label.isascii() in python 3.7
-        if not all(ord(char) < 128 for char in label):
+        if not _isascii(label):
             label = idna.encode(label).decode('utf-8')
         res.append(label)
     return ".".join(res)
@@ -116,3 +144,41 @@ def get_network_from_zonename(name):
         for i in it:
             net += "%s%s%s%s:" % (i, next(it, '0'), next(it, '0'), next(it, '0'))
         return ipaddress.ip_network("{}:/{}".format(net, netmask))
+
+
+def ip_to_int(ip):
+    """
+    Returns an IP address in the canonical form from the database as an
+    integer, without the overhead of creating an ipaddress object.
+    """
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    return int.from_bytes(socket.inet_pton(family, ip), 'big')
+
+
+def collapse_ranges(values):
+    """
+    Yields sorted integers as (first, last) ranges of consecutive values.
+    """
+    values = iter(values)
+    for first in values:
+        last = first
+        for value in values:
+            if value > last + 1:
+                yield first, last
+                first = value
+            last = value
+        yield first, last
+
+
+def merge_ranges(ranges):
+    """
+    Returns (first, last) integer ranges sorted, with overlapping and
+    adjacent ranges merged.
+    """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
@@ -186,6 +186,27 @@ DJANGO_LOGGING = {
     "CONSOLE_LOG": False,
 }
 
+# Directory where generated zonefiles are cached, keyed on zone name and
+# serial number, e.g. os.path.join(BASE_DIR, 'zonefile_cache'). It must be
+# writable by the server. The cache is disabled when None.
+ZONEFILE_CACHE_DIR = None
+# Number of zonefiles for earlier serial numbers to keep per zone, used to
+# find the changes since a serial number.
+ZONEFILE_CACHE_SNAPSHOTS = 10
+# The in-memory index of network and reverse zone ranges checks for changes
+# done by other processes once per request, and otherwise at most every this
+# many seconds. Set to 0 to disable it.
+PREFIX_INDEX_TTL = 60
+# Seconds to cache bitmaps of the used addresses in IPv4 networks up to /16,
+# which are updated by changes in this process only. Set to 0 to disable.
+NETWORK_USAGE_CACHE_TTL = 0
+# Save the host history snapshots in a background thread after commit,
+# instead of before the response is sent.
+HOST_HISTORY_IN_BACKGROUND = False
+# Save a full host snapshot every this many history entries, and deltas
+# against the previous entry in between. Set to 1 to only save snapshots.
+HOST_HISTORY_KEYFRAME_INTERVAL = 10
+
 SWAGGER_SETTINGS = {
     'USE_SESSION_AUTH': False,
 }